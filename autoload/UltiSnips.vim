@@ -131,10 +131,44 @@ function! UltiSnips#Anon(value, ...) abort
     return ""
 endfunction
 
+function! UltiSnips#ShellCacheStats() abort
+    py3 from UltiSnips.text_objects.shell_code import cache_stats
+    py3 vim.command("let stats = {'hits': %(hits)i, 'misses': %(misses)i, 'size': %(size)i}" % cache_stats())
+    return stats
+endfunction
+
+function! UltiSnips#ShellRuns() abort
+    py3 import json
+    py3 from UltiSnips.text_objects.shell_code import shell_runs
+    py3 vim.command("let runs = json_decode('%s')" % json.dumps(shell_runs()).replace("'", "''"))
+    return runs
+endfunction
+
 function! UltiSnips#CursorMoved() abort
     py3 UltiSnips_Manager._cursor_moved()
 endf
 
+function! UltiSnips#BackgroundRunsPoll(timer) abort
+    py3 UltiSnips_Manager._background_runs_poll()
+endfunction
+
+function! UltiSnips#TrackBufferChanges(bufnr, start, end, added, changes) abort
+    call add(g:_ultisnips_buffer_changes, [a:start, a:end, a:added])
+endfunction
+
+function! UltiSnips#EvaluateInOrder(expressions) abort
+    " Returns the values of the expressions up to the first that fails.
+    let values = []
+    for expression in a:expressions
+        try
+            call add(values, eval(expression))
+        catch
+            break
+        endtry
+    endfor
+    return values
+endfunction
+
 function! UltiSnips#LeavingBuffer() abort
     let from_preview = getwinvar(winnr('#'), '&previewwindow')
     let to_preview = getwinvar(winnr(), '&previewwindow')
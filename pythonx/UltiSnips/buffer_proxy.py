@@ -3,7 +3,6 @@
 import vim
 from UltiSnips import vim_helper
 from UltiSnips.position import Position
-from UltiSnips.diff import diff
 
 from contextlib import contextmanager
 
@@ -19,8 +18,18 @@ def use_proxy_buffer(snippets_stack, vstate):
     try:
         vim_helper.buf = buffer_proxy
         yield
+    except Exception:
+        vim_helper.buf = old_buffer
+        # Remember the changes made before the error if possible, but report
+        # the error of the function.
+        try:
+            buffer_proxy.remember_changes()
+        except Exception:  # pylint:disable=broad-except
+            pass
+        raise
     finally:
         vim_helper.buf = old_buffer
+    buffer_proxy.remember_changes()
     buffer_proxy.validate_buffer()
 
 
@@ -52,9 +61,10 @@ class VimBufferProxy(vim_helper.VimBuffer):
     Instance of this class is passed to all snippet actions and behaves as
     internal vim.current.window.buffer.
 
-    All changes that are made by user passed to diff algorithm, and resulting
-    diff applied to internal snippet structures to ensure they are in sync with
-    actual buffer contents.
+    All changes that are made by user are turned into edit commands from the
+    replaced lines, and these are applied to internal snippet structures to
+    ensure they are in sync with actual buffer contents. The buffer is
+    remembered once for all of them by remember_changes().
     """
 
     def __init__(self, snippets_stack, vstate):
@@ -68,6 +78,7 @@ class VimBufferProxy(vim_helper.VimBuffer):
         self._change_tick = int(vim.eval("b:changedtick"))
         self._forward_edits = True
         self._vstate = vstate
+        self._changed = False
 
     def is_buffer_changed_outside(self):
         """
@@ -96,10 +107,9 @@ class VimBufferProxy(vim_helper.VimBuffer):
         """
         if isinstance(key, slice):
             value = [line for line in value]
-            changes = list(self._get_diff(key.start, key.stop, value))
+            changes = self._get_changes(key.start, key.stop, value)
             self._buffer[key.start : key.stop] = [line.strip("\n") for line in value]
         else:
-            value = value
             changes = list(self._get_line_diff(key, self._buffer[key], value))
             self._buffer[key] = value
 
@@ -108,8 +118,17 @@ class VimBufferProxy(vim_helper.VimBuffer):
         if self._forward_edits:
             for change in changes:
                 self._apply_change(change)
-            if self._snippets_stack:
-                self._vstate.remember_buffer(self._snippets_stack[0])
+            self._changed = True
+
+    def remember_changes(self):
+        """
+        Remembers the buffer after the changes made since the last call.
+        """
+        if not self._changed:
+            return
+        self._changed = False
+        if self._snippets_stack:
+            self._vstate.remember_buffer(self._snippets_stack[0])
 
     def __setslice__(self, i, j, text):
         """
@@ -165,16 +184,73 @@ class VimBufferProxy(vim_helper.VimBuffer):
         for line_number in range(0, len(new_value)):
             yield ("I", start + line_number, 0, new_value[line_number], True)
 
+    def _get_changes(self, start, end, new_value):
+        """
+        Changes for replacing the lines 'start' to 'end' with 'new_value'.
+        Lines that stay the same at both ends are left out.
+        """
+        start, end, _ = slice(start, end).indices(len(self._buffer))
+        end = max(start, end)
+        old_value = self._buffer[start:end]
+        first = 0
+        while (
+            first < min(len(old_value), len(new_value))
+            and old_value[first] == new_value[first]
+        ):
+            first += 1
+        old_last, new_last = len(old_value), len(new_value)
+        while (
+            old_last > first
+            and new_last > first
+            and old_value[old_last - 1] == new_value[new_last - 1]
+        ):
+            old_last -= 1
+            new_last -= 1
+        if old_last - first == 1 and new_last - first == 1:
+            return list(
+                self._get_line_diff(
+                    start + first, old_value[first], new_value[first]
+                )
+            )
+        return list(
+            self._get_diff(
+                start + first, start + old_last, new_value[first:new_last]
+            )
+        )
+
     def _get_line_diff(self, line_number, before, after):
         """
-        Use precise diffing for tracking changes in single line.
+        Replacing the text between the common prefix and suffix of 'before'
+        and 'after' is the change in a single line. The new text is inserted
+        before the old one is deleted, so that it stays with the text before
+        it rather than going into an empty tabstop behind it.
         """
         if before == "":
             for change in self._get_diff(line_number, line_number + 1, [after]):
                 yield change
-        else:
-            for change in diff(before, after):
-                yield (change[0], line_number, change[2], change[3])
+            return
+        prefix = 0
+        while (
+            prefix < min(len(before), len(after))
+            and before[prefix] == after[prefix]
+        ):
+            prefix += 1
+        suffix = 0
+        while (
+            suffix < min(len(before), len(after)) - prefix
+            and before[-1 - suffix] == after[-1 - suffix]
+        ):
+            suffix += 1
+        inserted = after[prefix : len(after) - suffix]
+        if inserted:
+            yield ("I", line_number, prefix, inserted)
+        if len(before) - suffix > prefix:
+            yield (
+                "D",
+                line_number,
+                prefix + len(inserted),
+                before[prefix : len(before) - suffix],
+            )
 
     def _apply_change(self, change):
         """
@@ -211,6 +287,7 @@ class VimBufferProxy(vim_helper.VimBuffer):
         while expanding anonymous snippet in the middle of jump to prevent
         double tracking.
         """
+        self.remember_changes()
         self._forward_edits = False
 
     def _enable_edits(self):
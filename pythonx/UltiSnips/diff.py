@@ -155,6 +155,65 @@ def guess_edit(initial_line, last_text, current_text, vim_state):
     return False, None
 
 
+def edits_from_changed_lines(initial_line, last_text, current_text, cursor):
+    """Returns the edit commands that turn the lines 'last_text' into the lines
+    'current_text'. Both start at 'initial_line' and are known to contain the
+    complete change, for example because Vim reported it to us.
+
+    A plain insertion or deletion is found directly, as is a replacement that
+    ends at 'cursor' (typing over a selection). When the changed text is
+    ambiguous (e.g. typing 'a' into 'aa'), the edit is placed so that it ends
+    at 'cursor'. Anything else might be several changes at once (e.g.
+    ':s/foo/bar/g') and is left to diff().
+
+    """
+    old = "\n".join(last_text)
+    new = "\n".join(current_text)
+
+    max_suffix = len(new)
+    offset = None
+    if initial_line <= cursor.line < initial_line + len(current_text):
+        offset = cursor.col
+        for line in current_text[: cursor.line - initial_line]:
+            offset += len(line) + 1
+        max_suffix = max(0, len(new) - offset)
+
+    suffix = 0
+    max_suffix = min(max_suffix, len(old), len(new))
+    while suffix < max_suffix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    prefix = 0
+    max_prefix = min(len(old), len(new)) - suffix
+    while prefix < max_prefix and old[prefix] == new[prefix]:
+        prefix += 1
+
+    deleted = old[prefix : len(old) - suffix]
+    inserted = new[prefix : len(new) - suffix]
+    if deleted and inserted and len(new) - suffix != offset:
+        return diff(old, new, initial_line)
+
+    line = initial_line + old.count("\n", 0, prefix)
+    col = prefix - (old.rfind("\n", 0, prefix) + 1)
+
+    es = []
+    deleted = deleted.split("\n")
+    for idx, text in enumerate(deleted):
+        if text:
+            es.append(("D", line, col, text))
+        if idx != len(deleted) - 1:
+            es.append(("D", line, col, "\n"))
+    inserted = inserted.split("\n")
+    for idx, text in enumerate(inserted):
+        if text:
+            es.append(("I", line, col, text))
+            col += len(text)
+        if idx != len(inserted) - 1:
+            es.append(("I", line, col, "\n"))
+            line += 1
+            col = 0
+    return tuple(es)
+
+
 def diff(a, b, sline=0):
     """
     Return a list of deletions and insertions that will turn 'a' into 'b'. This
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Receives the changes made to the current buffer from Vim, so that we do not
+have to guess what the user typed.
+
+Vim (listener_add()) and Neovim (nvim_buf_attach()) notify us about each
+change. We only need to know which lines changed: the old lines are in the
+remembered buffer of VimState, the new lines are in Vim.
+
+"""
+
+from UltiSnips import vim_helper
+
+
+def _fold_changes(changes):
+    """Combines the reported 'changes' into one changed range. Each change is
+    (start, end, added) as passed to a listener_add() callback: the lines
+    'start' to 'end' (exclusive, 1 based) were replaced by 'end' - 'start' +
+    'added' lines.
+
+    Returns (first, last_before, last_after), the 0 based range of changed
+    lines before and after all changes, or None if nothing changed.
+
+    """
+    first = None
+    for start, end, added in changes:
+        start, end, added = int(start) - 1, int(end) - 1, int(added)
+        if first is None:
+            first, last, delta = start, end, 0
+        first = min(first, start)
+        last = max(last, end) + added
+        delta += added
+    if first is None:
+        return None
+    return first, last - delta, last
+
+
+class _EditSource:
+
+    """Base class for the change notifications of an editor."""
+
+    def attach(self):
+        """Starts listening for changes in the current buffer."""
+        raise NotImplementedError()
+
+    def detach(self):
+        """Stops listening for changes."""
+        raise NotImplementedError()
+
+    def _pending_changes(self):
+        """Returns and forgets the changes that were reported since the last
+        call."""
+        raise NotImplementedError()
+
+    def flush(self):
+        """Returns the range of lines that changed since the last flush as
+        (first, last_before, last_after) or None if nothing changed."""
+        return _fold_changes(self._pending_changes())
+
+
+class VimListenerEditSource(_EditSource):
+
+    """Uses listener_add(), available since Vim 8.1.1321."""
+
+    def __init__(self):
+        self._bufnr = None
+        self._listener_id = None
+
+    def attach(self):
+        self._bufnr = vim_helper.buf.number
+        vim_helper.command("let g:_ultisnips_buffer_changes = []")
+        self._listener_id = int(
+            vim_helper.eval(
+                "listener_add('UltiSnips#TrackBufferChanges', %i)" % self._bufnr
+            )
+        )
+
+    def detach(self):
+        if self._listener_id is None:
+            return
+        vim_helper.eval("listener_remove(%i)" % self._listener_id)
+        self._listener_id = None
+
+    def _pending_changes(self):
+        if self._listener_id is None:
+            return []
+        # Callbacks are only invoked before redraw, make sure we get all of them.
+        vim_helper.command("call listener_flush(%i)" % self._bufnr)
+        changes = vim_helper.eval("g:_ultisnips_buffer_changes")
+        vim_helper.command("let g:_ultisnips_buffer_changes = []")
+        return changes
+
+
+class NeovimEditSource(_EditSource):
+
+    """Uses the on_bytes callback of nvim_buf_attach(), available since Neovim
+    0.5.
+
+    The callback records the changes in the same format that Vim uses for
+    listener_add(). Each attach() gets a new id, so that callbacks of an old
+    attachment detach themselves.
+
+    """
+
+    _ATTACH = (
+        "_G._ultisnips_changes = {} "
+        "local id = (_G._ultisnips_listener_count or 0) + 1 "
+        "_G._ultisnips_listener_count = id "
+        "_G._ultisnips_listener = id "
+        "vim.api.nvim_buf_attach(0, false, {on_bytes = function(_, _, _, "
+        "start_row, _, _, old_end_row, _, _, new_end_row) "
+        "if _G._ultisnips_listener ~= id then return true end "
+        "table.insert(_G._ultisnips_changes, {start_row + 1, "
+        "start_row + old_end_row + 2, new_end_row - old_end_row}) end})"
+    )
+
+    def __init__(self):
+        self._attached = False
+
+    def attach(self):
+        vim_helper.command("lua " + self._ATTACH)
+        self._attached = True
+
+    def detach(self):
+        if not self._attached:
+            return
+        vim_helper.command("lua _G._ultisnips_listener = nil")
+        self._attached = False
+
+    def _pending_changes(self):
+        if not self._attached:
+            return []
+        changes = vim_helper.eval("luaeval('_G._ultisnips_changes')")
+        vim_helper.command("lua _G._ultisnips_changes = {}")
+        return changes
+
+
+def create_edit_source():
+    """Returns the edit source supported by the running Vim or None if it has
+    none."""
+    if vim_helper.eval("has('nvim-0.5')") == "1":
+        return NeovimEditSource()
+    if vim_helper.eval("exists('*listener_add')") == "1":
+        return VimListenerEditSource()
+    return None
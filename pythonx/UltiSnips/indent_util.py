@@ -6,20 +6,27 @@
 from UltiSnips import vim_helper
 
 
+def indent_settings():
+    """Reads the shiftwidth, expandtab and tabstop settings from Vim."""
+    return vim_helper.eval(
+        "[exists('*shiftwidth') ? shiftwidth() : &shiftwidth, &expandtab, &tabstop]"
+    )
+
+
 class IndentUtil:
 
     """Utility class for dealing properly with indentation."""
 
-    def __init__(self):
-        self.reset()
+    def __init__(self, settings=None):
+        self.reset(settings)
 
-    def reset(self):
-        """Gets the spacing properties from Vim."""
-        self.shiftwidth = int(
-            vim_helper.eval("exists('*shiftwidth') ? shiftwidth() : &shiftwidth")
-        )
-        self._expandtab = vim_helper.eval("&expandtab") == "1"
-        self._tabstop = int(vim_helper.eval("&tabstop"))
+    def reset(self, settings=None):
+        """Gets the spacing properties from Vim, or from 'settings' if they
+        were already read by indent_settings()."""
+        shiftwidth, expandtab, tabstop = settings or indent_settings()
+        self.shiftwidth = int(shiftwidth)
+        self._expandtab = expandtab == "1"
+        self._tabstop = int(tabstop)
 
     def ntabs_to_proper_indent(self, ntabs):
         """Convert 'ntabs' number of tabs to the proper indent prefix."""
@@ -74,3 +74,62 @@ class Position:
             return self.line
         else:
             return self.col
+
+
+class RelativePosition(Position):
+    """A Position that is stored relative to another one, its 'anchor'.
+
+    On the line of the anchor, the column is kept as an offset to the anchor's
+    column, on later lines as is. That is exactly what move() does to positions
+    behind a change, so when the anchor is moved, everything anchored to it
+    (and behind it) moves along without being touched. An anchor of None makes
+    this an absolute position. 'line' and 'col' are the absolute values; they
+    are cached until any RelativePosition changes.
+
+    """
+
+    _generation = 0
+
+    def __init__(self, anchor, line, col):
+        self._anchor = anchor
+        self._cached_generation = -1
+        self._cached = None
+        self._set(line, col)
+
+    def _set(self, line, col):
+        """Stores the absolute 'line' and 'col' relative to our anchor."""
+        RelativePosition._generation += 1
+        if self._anchor is None:
+            self._rline, self._rcol = line, col
+            return
+        aline, acol = self._anchor.line, self._anchor.col
+        self._rline = line - aline
+        self._rcol = col - acol if line == aline else col
+
+    def _absolute(self):
+        """Returns our absolute (line, col)."""
+        if self._cached_generation != RelativePosition._generation:
+            if self._anchor is None:
+                self._cached = (self._rline, self._rcol)
+            elif self._rline == 0:
+                self._cached = (self._anchor.line, self._anchor.col + self._rcol)
+            else:
+                self._cached = (self._anchor.line + self._rline, self._rcol)
+            self._cached_generation = RelativePosition._generation
+        return self._cached
+
+    @property
+    def line(self):
+        return self._absolute()[0]
+
+    @line.setter
+    def line(self, line):
+        self._set(line, self._absolute()[1])
+
+    @property
+    def col(self):
+        return self._absolute()[1]
+
+    @col.setter
+    def col(self, col):
+        self._set(self._absolute()[0], col)
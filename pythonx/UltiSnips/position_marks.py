@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Lets Vim track the positions of text objects while the user types.
+
+One mark is placed per Position: an extmark in Neovim or a zero width text
+property in Vim. The marks move with the text natively, so after a simple edit
+we can read all positions back in one call instead of moving every Position
+by hand. Marks use right gravity, i.e. text inserted at a mark pushes it to
+the right.
+
+"""
+
+from UltiSnips import vim_helper
+
+
+def _to_byte(line, col, encoding):
+    """Convert the column 'col' in 'line' to a byte index."""
+    return len(line[:col].encode(encoding, "replace"))
+
+
+def _to_col(line, nbyte, encoding):
+    """Convert the byte index 'nbyte' in 'line' to a column."""
+    return len(line.encode(encoding, "replace")[:nbyte].decode(encoding, "replace"))
+
+
+class _PositionMarks:
+
+    """Base class for the marks of one buffer."""
+
+    def __init__(self):
+        self._bufnr = vim_helper.buf.number
+        self._encoding = vim_helper.eval("&encoding")
+        self._count = 0
+        self._first_line = 0
+        self._last_line = 0
+        self._buffer_length = 0
+
+    def place(self, positions):
+        """Replaces all our marks with one mark for each of 'positions'."""
+        self._count = len(positions)
+        if not positions:
+            self._clear()
+            return
+        self._first_line = min(pos.line for pos in positions)
+        self._last_line = max(pos.line for pos in positions)
+        self._buffer_length = len(vim_helper.buf)
+        lines = vim_helper.buf[self._first_line : self._last_line + 1]
+        marks = []
+        for pos in positions:
+            line = lines[pos.line - self._first_line]
+            marks.append((pos.line, _to_byte(line, pos.col, self._encoding)))
+        self._place(marks)
+
+    def read(self):
+        """Returns the current (line, col) of all marks in the order they were
+        placed or None if Vim lost some of them."""
+        if not self._count:
+            return []
+        last_line = min(
+            len(vim_helper.buf) - 1,
+            self._last_line + max(0, len(vim_helper.buf) - self._buffer_length),
+        )
+        marks = self._read(self._first_line, last_line)
+        if len(marks) != self._count or None in marks:
+            return None
+        first = min(line for line, _ in marks)
+        last = max(line for line, _ in marks)
+        lines = vim_helper.buf[first : last + 1]
+        return [
+            (line, _to_col(lines[line - first], nbyte, self._encoding))
+            for line, nbyte in marks
+        ]
+
+    def clear(self):
+        """Removes all our marks."""
+        self._count = 0
+        self._clear()
+
+    def _place(self, marks):
+        """Places a mark for each (line, byte) in 'marks', 0 based."""
+        raise NotImplementedError()
+
+    def _read(self, first_line, last_line):
+        """Returns the (line, byte) of all marks, indexed by their order of
+        placement. They are expected in the lines 'first_line' to
+        'last_line'."""
+        raise NotImplementedError()
+
+    def _clear(self):
+        """Removes all marks from Vim."""
+        raise NotImplementedError()
+
+
+class NeovimExtmarks(_PositionMarks):
+
+    """Uses extmarks in their own namespace."""
+
+    _FUNCTIONS = (
+        "_G._ultisnips_place_marks = function(buf, marks) "
+        "local ns = vim.api.nvim_create_namespace('UltiSnipsPositions') "
+        "vim.api.nvim_buf_clear_namespace(buf, ns, 0, -1) "
+        "for i, m in ipairs(marks) do "
+        "vim.api.nvim_buf_set_extmark(buf, ns, m[1], m[2], "
+        "{id = i, right_gravity = true}) end end "
+        "_G._ultisnips_read_marks = function(buf) "
+        "local ns = vim.api.nvim_create_namespace('UltiSnipsPositions') "
+        "local rv = {} "
+        "for _, m in ipairs(vim.api.nvim_buf_get_extmarks(buf, ns, 0, -1, {})) do "
+        "rv[#rv + 1] = {m[1], m[2], m[3]} end return rv end"
+    )
+
+    def __init__(self):
+        _PositionMarks.__init__(self)
+        vim_helper.command("lua " + self._FUNCTIONS)
+
+    def _place(self, marks):
+        vim_helper.command(
+            "lua _G._ultisnips_place_marks(%i, {%s})"
+            % (self._bufnr, ",".join("{%i,%i}" % mark for mark in marks))
+        )
+
+    def _read(self, first_line, last_line):
+        rv = [None] * self._count
+        for mark_id, line, nbyte in vim_helper.eval(
+            "luaeval('_G._ultisnips_read_marks(%i)')" % self._bufnr
+        ):
+            mark_id = int(mark_id) - 1
+            if 0 <= mark_id < self._count:
+                rv[mark_id] = (int(line), int(nbyte))
+        return rv
+
+    def _clear(self):
+        vim_helper.command(
+            "lua vim.api.nvim_buf_clear_namespace(%i, "
+            "vim.api.nvim_create_namespace('UltiSnipsPositions'), 0, -1)"
+            % self._bufnr
+        )
+
+
+class VimTextProperties(_PositionMarks):
+
+    """Uses zero width text properties of their own type."""
+
+    _TYPE = "UltiSnipsPosition"
+
+    def __init__(self):
+        _PositionMarks.__init__(self)
+        vim_helper.command(
+            "if empty(prop_type_get('%s')) | call prop_type_add('%s', "
+            "{'start_incl': 0, 'end_incl': 0}) | endif" % (self._TYPE, self._TYPE)
+        )
+
+    def _place(self, marks):
+        commands = [
+            "silent! call prop_remove({'type': '%s', 'bufnr': %i, 'all': 1})"
+            % (self._TYPE, self._bufnr)
+        ]
+        for mark_id, (line, nbyte) in enumerate(marks, 1):
+            commands.append(
+                "call prop_add(%i, %i, {'type': '%s', 'bufnr': %i, 'id': %i, "
+                "'length': 0})"
+                % (line + 1, nbyte + 1, self._TYPE, self._bufnr, mark_id)
+            )
+        vim_helper.command(" | ".join(commands))
+
+    def _read(self, first_line, last_line):
+        rv = [None] * self._count
+        all_props = vim_helper.eval(
+            "map(range(%i, %i), 'prop_list(v:val, {\"bufnr\": %i})')"
+            % (first_line + 1, last_line + 1, self._bufnr)
+        )
+        for line, props in enumerate(all_props, first_line):
+            for prop in props:
+                if prop["type"] != self._TYPE:
+                    continue
+                mark_id = int(prop["id"]) - 1
+                if 0 <= mark_id < self._count:
+                    rv[mark_id] = (line, int(prop["col"]) - 1)
+        return rv
+
+    def _clear(self):
+        vim_helper.command(
+            "silent! call prop_remove({'type': '%s', 'bufnr': %i, 'all': 1})"
+            % (self._TYPE, self._bufnr)
+        )
+
+
+def create_position_marks():
+    """Returns the position marks supported by the running Vim or None if it
+    has none."""
+    if vim_helper.eval("exists('*nvim_buf_set_extmark')") == "1":
+        return NeovimExtmarks()
+    if vim_helper.eval("has('textprop')") == "1":
+        return VimTextProperties()
+    return None
@@ -13,7 +13,11 @@ from UltiSnips.indent_util import IndentUtil
 from UltiSnips.text import escape
 from UltiSnips.text_objects import SnippetInstance
 from UltiSnips.position import Position
-from UltiSnips.text_objects.python_code import SnippetUtilForAction
+from UltiSnips.text_objects.python_code import (
+    SnippetUtilForAction,
+    layer_on_globals,
+    running_in,
+)
 
 __WHITESPACE_SPLIT = re.compile(r"\s")
 
@@ -107,6 +111,7 @@ class SnippetDefinition:
         self._context_code = context
         self._context = None
         self._actions = actions or {}
+        self._templates = {}
 
         # Make sure that we actually match our trigger in case we are
         # immediately expanded.
@@ -156,41 +161,36 @@ class SnippetDefinition:
         return self._eval_code("snip.context = " + self._context_code, locals).context
 
     def _eval_code(self, code, additional_locals={}):
-        code = "\n".join(
-            [
-                "import re, os, vim, string, random",
-                "\n".join(self._globals.get("!p", [])).replace("\r\n", "\n"),
-                code,
-            ]
-        )
-
         current = vim.current
+        window = current.window
+        cursor = window.cursor
 
         locals = {
-            "window": current.window,
+            "window": window,
             "buffer": current.buffer,
-            "line": current.window.cursor[0] - 1,
-            "column": current.window.cursor[1] - 1,
-            "cursor": _SnippetUtilCursor(current.window.cursor),
+            "line": cursor[0] - 1,
+            "column": cursor[1] - 1,
+            "cursor": _SnippetUtilCursor(cursor),
         }
 
         locals.update(additional_locals)
 
         snip = SnippetUtilForAction(locals)
 
+        local_vars = layer_on_globals(self._globals, {"snip": snip})
         try:
-            exec(code, {"snip": snip})
+            with running_in(local_vars):
+                exec(code, local_vars)
         except Exception as e:
-            self._make_debug_exception(e, code)
+            self._make_debug_exception(e, getattr(e, "snippet_code", code))
             raise
 
         return snip
 
     def _execute_action(self, action, context, additional_locals={}):
         mark_to_use = "`"
-        with vim_helper.save_mark(mark_to_use):
-            vim_helper.set_mark_from_pos(mark_to_use, vim_helper.get_cursor_pos())
-
+        old_mark_pos = vim_helper.mark_cursor(mark_to_use)
+        try:
             cursor_line_before = vim_helper.buf.line_till_cursor
 
             locals = {"context": context}
@@ -198,30 +198,35 @@ class SnippetDefinition:
             locals.update(additional_locals)
 
             snip = self._eval_code(action, locals)
+        except:
+            vim_helper.restore_mark(mark_to_use, old_mark_pos)
+            raise
 
-            if snip.cursor.is_set():
-                vim_helper.buf.cursor = Position(
-                    snip.cursor._cursor[0], snip.cursor._cursor[1]
-                )
-            else:
-                new_mark_pos = vim_helper.get_mark_pos(mark_to_use)
+        if snip.cursor.is_set():
+            vim_helper.buf.cursor = Position(
+                snip.cursor._cursor[0], snip.cursor._cursor[1]
+            )
+            vim_helper.restore_mark(mark_to_use, old_mark_pos)
+        else:
+            # The cursor is moved to where the mark went while restoring it.
+            new_mark_pos = vim_helper.restore_mark(
+                mark_to_use, old_mark_pos, move_cursor=True
+            )
 
-                cursor_invalid = False
+            cursor_invalid = False
 
-                if vim_helper._is_pos_zero(new_mark_pos):
-                    cursor_invalid = True
-                else:
-                    vim_helper.set_cursor_from_pos(new_mark_pos)
-                    if cursor_line_before != vim_helper.buf.line_till_cursor:
-                        cursor_invalid = True
+            if vim_helper._is_pos_zero(new_mark_pos):
+                cursor_invalid = True
+            elif cursor_line_before != vim_helper.buf.line_till_cursor:
+                cursor_invalid = True
 
-                if cursor_invalid:
-                    raise RuntimeError(
-                        "line under the cursor was modified, but "
-                        + '"snip.cursor" variable is not set; either set set '
-                        + '"snip.cursor" to new cursor position, or do not '
-                        + "modify cursor line"
-                    )
+            if cursor_invalid:
+                raise RuntimeError(
+                    "line under the cursor was modified, but "
+                    + '"snip.cursor" variable is not set; either set set '
+                    + '"snip.cursor" to new cursor position, or do not '
+                    + "modify cursor line"
+                )
 
         return snip
 
@@ -253,6 +258,11 @@ class SnippetDefinition:
         """Check if the named option is set."""
         return opt in self._opts
 
+    def has_action(self, action):
+        """Check if the named action ('pre_expand', 'post_expand' or
+        'post_jump') is defined."""
+        return action in self._actions
+
     @property
     def description(self):
         """Descriptive text for this snippet."""
@@ -389,7 +399,7 @@ class SnippetDefinition:
         raise NotImplementedError()
 
     def do_pre_expand(self, visual_content, snippets_stack):
-        if "pre_expand" in self._actions:
+        if self.has_action("pre_expand"):
             locals = {"buffer": vim_helper.buf, "visual_content": visual_content}
 
             snip = self._execute_action(
@@ -401,7 +411,7 @@ class SnippetDefinition:
             return False
 
     def do_post_expand(self, start, end, snippets_stack):
-        if "post_expand" in self._actions:
+        if self.has_action("post_expand"):
             locals = {
                 "snippet_start": start,
                 "snippet_end": end,
@@ -421,7 +431,7 @@ class SnippetDefinition:
     def do_post_jump(
         self, tabstop_number, jump_direction, snippets_stack, current_snippet
     ):
-        if "post_jump" in self._actions:
+        if self.has_action("post_jump"):
             start = current_snippet.start
             end = current_snippet.end
 
@@ -484,6 +494,7 @@ class SnippetDefinition:
             context=self._context,
         )
         self.instantiate(snippet_instance, initial_text, indent)
-        snippet_instance.replace_initial_text(vim_helper.buf)
-        snippet_instance.update_textobjects(vim_helper.buf)
+        with vim_helper.defer_buffer_writes(start.line, end.line):
+            snippet_instance.replace_initial_text(vim_helper.buf)
+            snippet_instance.update_textobjects(vim_helper.buf)
         return snippet_instance
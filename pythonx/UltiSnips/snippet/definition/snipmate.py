@@ -28,4 +28,6 @@ class SnipMateSnippetDefinition(SnippetDefinition):
         )
 
     def instantiate(self, snippet_instance, initial_text, indent):
-        parse_and_instantiate(snippet_instance, initial_text, indent)
+        parse_and_instantiate(
+            snippet_instance, initial_text, indent, self._templates
+        )
@@ -12,4 +12,6 @@ class UltiSnipsSnippetDefinition(SnippetDefinition):
     """See module doc."""
 
     def instantiate(self, snippet_instance, initial_text, indent):
-        return parse_and_instantiate(snippet_instance, initial_text, indent)
+        return parse_and_instantiate(
+            snippet_instance, initial_text, indent, self._templates
+        )
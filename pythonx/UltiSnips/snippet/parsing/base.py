@@ -3,6 +3,8 @@
 
 """Common functionality of the snippet parsing codes."""
 
+import copy
+
 from UltiSnips.position import Position
 from UltiSnips.snippet.parsing.lexer import tokenize, TabStopToken
 from UltiSnips.text_objects import TabStop
@@ -25,6 +27,41 @@ def resolve_ambiguity(all_tokens, seen_ts):
                 Mirror(parent, seen_ts[token.number], token)
 
 
+def _parse_template(text, indent, allowed_tokens_in_text, allowed_tokens_in_tabstops):
+    """Turns 'text' into a tree of tokens as if the snippet started at (0, 0).
+    Returns a list of (token, children) where 'children' is the template of
+    the placeholder text for a TabStopToken and None for all other tokens."""
+
+    def _do_parse(text, offset, allowed_tokens):
+        """Recursive function that actually tokenizes."""
+        template = []
+        for token in tokenize(text, indent, offset, allowed_tokens):
+            children = None
+            if isinstance(token, TabStopToken):
+                children = _do_parse(
+                    token.initial_text, token.start, allowed_tokens_in_tabstops
+                )
+            template.append((token, children))
+        return template
+
+    return _do_parse(text, Position(0, 0), allowed_tokens_in_text)
+
+
+def _offset_position(pos, offset):
+    """Returns 'pos', which is relative to (0, 0), relative to 'offset'."""
+    if pos.line == 0:
+        return Position(offset.line, offset.col + pos.col)
+    return Position(offset.line + pos.line, pos.col)
+
+
+def _offset_token(token, offset):
+    """Returns a copy of 'token' that is moved from (0, 0) to 'offset'."""
+    rv = copy.copy(token)
+    rv.start = _offset_position(token.start, offset)
+    rv.end = _offset_position(token.end, offset)
+    return rv
+
+
 def tokenize_snippet_text(
     snippet_instance,
     text,
@@ -32,6 +69,7 @@ def tokenize_snippet_text(
     allowed_tokens_in_text,
     allowed_tokens_in_tabstops,
     token_to_textobject,
+    templates=None,
 ):
     """Turns 'text' into a stream of tokens and creates the text objects from
     those tokens that are mentioned in 'token_to_textobject' assuming the
@@ -41,19 +79,32 @@ def tokenize_snippet_text(
     in 'text' while 'allowed_tokens_in_tabstops' are the tokens that
     will be recognized in TabStop placeholder text.
 
+    If 'templates' is a dict, the parsed tokens are cached in it, so that
+    'text' is only tokenized the first time it is seen with this 'indent'.
+
     """
+    key = (text, indent)
+    template = templates.get(key) if templates is not None else None
+    if template is None:
+        template = _parse_template(
+            text, indent, allowed_tokens_in_text, allowed_tokens_in_tabstops
+        )
+        if templates is not None:
+            templates[key] = template
+
     seen_ts = {}
     all_tokens = []
+    offset = snippet_instance.start
 
-    def _do_parse(parent, text, allowed_tokens):
+    def _do_instantiate(parent, template):
         """Recursive function that actually creates the objects."""
-        tokens = list(tokenize(text, indent, parent.start, allowed_tokens))
-        for token in tokens:
+        for token, children in template:
+            token = _offset_token(token, offset)
             all_tokens.append((parent, token))
             if isinstance(token, TabStopToken):
                 ts = TabStop(parent, token)
                 seen_ts[token.number] = ts
-                _do_parse(ts, token.initial_text, allowed_tokens_in_tabstops)
+                _do_instantiate(ts, children)
             else:
                 klass = token_to_textobject.get(token.__class__, None)
                 if klass is not None:
@@ -63,7 +114,7 @@ def tokenize_snippet_text(
                     if isinstance(text_object, TabStop):
                         seen_ts[text_object.number] = text_object
 
-    _do_parse(snippet_instance, text, allowed_tokens_in_text)
+    _do_instantiate(snippet_instance, template)
     return all_tokens, seen_ts
 
 
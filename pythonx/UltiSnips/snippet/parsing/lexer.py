@@ -4,8 +4,9 @@
 """Not really a lexer in the classical sense, but code to convert snippet
 definitions into logical units called Tokens."""
 
-import string
 import re
+from bisect import bisect_left
+from typing import Dict, Optional, Pattern, Tuple, Type
 
 from UltiSnips.position import Position
 from UltiSnips.text import unescape
@@ -13,12 +14,18 @@ from UltiSnips.text import unescape
 
 class _TextIterator:
 
-    """Helper class to make iterating over text easier."""
+    """Helper class to make iterating over text easier.
+
+    Only the index into the text is tracked, line and column are computed
+    from it when they are needed.
+
+    """
 
     def __init__(self, text, offset):
         self._text = text
         self._line = offset.line
         self._col = offset.col
+        self._newlines = [idx for idx, char in enumerate(text) if char == "\n"]
 
         self._idx = 0
 
@@ -31,14 +38,8 @@ class _TextIterator:
         if self._idx >= len(self._text):
             raise StopIteration
 
-        rv = self._text[self._idx]
-        if self._text[self._idx] in ("\n", "\r\n"):
-            self._line += 1
-            self._col = 0
-        else:
-            self._col += 1
         self._idx += 1
-        return rv
+        return self._text[self._idx - 1]
 
     def peek(self, count=1):
         """Returns the next 'count' characters without advancing the stream."""
@@ -49,20 +50,44 @@ class _TextIterator:
         except IndexError:
             return None
 
+    def match(self, regex):
+        """Matches 'regex' at the current position without advancing."""
+        return regex.match(self._text, self._idx)
+
+    def search(self, regex):
+        """Finds the next match of 'regex' without advancing."""
+        return regex.search(self._text, self._idx)
+
+    def read_to(self, idx):
+        """Returns the text up to the index 'idx' and advances to it."""
+        rv = self._text[self._idx : idx]
+        self._idx = idx
+        return rv
+
+    def read_to_end(self):
+        """Advances to the end of the text and raises StopIteration, like
+        __next__ would have done eventually."""
+        self._idx = len(self._text)
+        raise StopIteration
+
     @property
     def pos(self):
         """Current position in the text."""
-        return Position(self._line, self._col)
+        line = bisect_left(self._newlines, self._idx)
+        if line == 0:
+            return Position(self._line, self._col + self._idx)
+        return Position(self._line + line, self._idx - self._newlines[line - 1] - 1)
+
+
+_NUMBER = re.compile(r"[0-9]*")
+_BRACES = re.compile(r"\\[{}]|[{}]")
+_UNESCAPED_CHARS: Dict[str, Pattern[str]] = {}
 
 
 def _parse_number(stream):
     """Expects the stream to contain a number next, returns the number without
     consuming any more bytes."""
-    rv = ""
-    while stream.peek() and stream.peek() in string.digits:
-        rv += next(stream)
-
-    return int(rv)
+    return int(stream.read_to(stream.match(_NUMBER).end()))
 
 
 def _parse_till_closing_brace(stream):
@@ -72,21 +97,23 @@ def _parse_till_closing_brace(stream):
 
     Will also consume the closing }, but not return it
     """
-    rv = ""
+    rv = []
     in_braces = 1
     while True:
-        if EscapeCharToken.starts_here(stream, "{}"):
-            rv += next(stream) + next(stream)
-        else:
-            char = next(stream)
+        match = stream.search(_BRACES)
+        if match is None:
+            stream.read_to_end()
+        rv.append(stream.read_to(match.start()))
+        char = stream.read_to(match.end())
+        if len(char) == 1:
             if char == "{":
                 in_braces += 1
-            elif char == "}":
+            else:
                 in_braces -= 1
             if in_braces == 0:
                 break
-            rv += char
-    return rv
+        rv.append(char)
+    return "".join(rv)
 
 
 def _parse_till_unescaped_char(stream, chars):
@@ -96,25 +123,31 @@ def _parse_till_unescaped_char(stream, chars):
     Will also consume the closing char, but and return it as second
     return value
     """
-    rv = ""
+    if chars not in _UNESCAPED_CHARS:
+        _UNESCAPED_CHARS[chars] = re.compile(
+            r"\\[{0}]|[{0}]".format(re.escape(chars))
+        )
+    regex = _UNESCAPED_CHARS[chars]
+    rv = []
     while True:
-        escaped = False
-        for char in chars:
-            if EscapeCharToken.starts_here(stream, char):
-                rv += next(stream) + next(stream)
-                escaped = True
-        if not escaped:
-            char = next(stream)
-            if char in chars:
-                break
-            rv += char
-    return rv, char
+        match = stream.search(regex)
+        if match is None:
+            stream.read_to_end()
+        rv.append(stream.read_to(match.start()))
+        char = stream.read_to(match.end())
+        if len(char) == 1:
+            break
+        rv.append(char)
+    return "".join(rv), char
 
 
 class Token:
 
     """Represents a Token as parsed from a snippet definition."""
 
+    # Regular expression that matches where this token starts.
+    PATTERN: Optional[str] = None
+
     def __init__(self, gen, indent):
         self.initial_text = ""
         self.start = gen.pos
@@ -130,13 +163,7 @@ class TabStopToken(Token):
 
     """${1:blub}"""
 
-    CHECK = re.compile(r"^\${\d+[:}]")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+    PATTERN = r"\${\d+[:}]"
 
     def _parse(self, stream, indent):
         next(stream)  # $
@@ -161,13 +188,7 @@ class VisualToken(Token):
 
     """${VISUAL}"""
 
-    CHECK = re.compile(r"^\${VISUAL[:}/]")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+    PATTERN = r"\${VISUAL[:}/]"
 
     def _parse(self, stream, indent):
         for _ in range(8):  # ${VISUAL
@@ -200,13 +221,7 @@ class TransformationToken(Token):
 
     """${1/match/replace/options}"""
 
-    CHECK = re.compile(r"^\${\d+\/")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+    PATTERN = r"\${\d+\/"
 
     def _parse(self, stream, indent):
         next(stream)  # $
@@ -234,13 +249,7 @@ class MirrorToken(Token):
 
     """$1."""
 
-    CHECK = re.compile(r"^\$\d+")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+    PATTERN = r"\$\d+"
 
     def _parse(self, stream, indent):
         next(stream)  # $
@@ -257,13 +266,7 @@ class ChoicesToken(Token):
          so its content will not be parsed recursively.
     """
 
-    CHECK = re.compile(r"^\${\d+\|")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+    PATTERN = r"\${\d+\|"
 
     def _parse(self, stream, indent):
         next(stream)  # $
@@ -318,13 +321,7 @@ class EscapeCharToken(Token):
 
     """\\n."""
 
-    @classmethod
-    def starts_here(cls, stream, chars=r"{}\$`"):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        cs = stream.peek(2)
-        if len(cs) == 2 and cs[0] == "\\" and cs[1] in chars:
-            return True
+    PATTERN = r"\\[{}\\$`]"
 
     def _parse(self, stream, indent):
         next(stream)  # \
@@ -338,11 +335,7 @@ class ShellCodeToken(Token):
 
     """`echo "hi"`"""
 
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return stream.peek(1) == "`"
+    PATTERN = r"`"
 
     def _parse(self, stream, indent):
         next(stream)  # `
@@ -356,13 +349,7 @@ class PythonCodeToken(Token):
 
     """`!p snip.rv = "Hi"`"""
 
-    CHECK = re.compile(r"^`!p\s")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(4)) is not None
+    PATTERN = r"`!p\s"
 
     def _parse(self, stream, indent):
         for _ in range(3):
@@ -389,13 +376,7 @@ class VimLCodeToken(Token):
 
     """`!v g:hi`"""
 
-    CHECK = re.compile(r"^`!v\s")
-
-    @classmethod
-    def starts_here(cls, stream):
-        """Returns true if this token starts at the current position in
-        'stream'."""
-        return cls.CHECK.match(stream.peek(4)) is not None
+    PATTERN = r"`!v\s"
 
     def _parse(self, stream, indent):
         for _ in range(4):
@@ -414,20 +395,36 @@ class EndOfTextToken(Token):
         return "EndOfText(%r)" % self.end
 
 
+_START_PATTERNS: Dict[Tuple[Type["Token"], ...], Pattern[str]] = {}
+
+
+def _start_pattern(allowed_tokens):
+    """Returns one regular expression that finds where the next of the
+    'allowed_tokens' starts. If several tokens start at the same position,
+    the one that comes first in 'allowed_tokens' matches."""
+    allowed_tokens = tuple(allowed_tokens)
+    if allowed_tokens not in _START_PATTERNS:
+        _START_PATTERNS[allowed_tokens] = re.compile(
+            "|".join(
+                "(?P<t%i>%s)" % (idx, token.PATTERN)
+                for idx, token in enumerate(allowed_tokens)
+            )
+        )
+    return _START_PATTERNS[allowed_tokens]
+
+
 def tokenize(text, indent, offset, allowed_tokens):
     """Returns an iterator of tokens of 'text'['offset':] which is assumed to
     have 'indent' as the whitespace of the begging of the lines. Only
     'allowed_tokens' are considered to be valid tokens."""
     stream = _TextIterator(text, offset)
+    start_pattern = _start_pattern(allowed_tokens)
     try:
         while True:
-            done_something = False
-            for token in allowed_tokens:
-                if token.starts_here(stream):
-                    yield token(stream, indent)
-                    done_something = True
-                    break
-            if not done_something:
-                next(stream)
+            match = stream.search(start_pattern)
+            if match is None:
+                stream.read_to_end()
+            stream.read_to(match.start())
+            yield allowed_tokens[int(match.lastgroup[1:])](stream, indent)
     except StopIteration:
         yield EndOfTextToken(stream, indent)
@@ -65,12 +65,13 @@ def _create_transformations(all_tokens, seen_ts):
             Transformation(parent, seen_ts[token.number], token)
 
 
-def parse_and_instantiate(parent_to, text, indent):
+def parse_and_instantiate(parent_to, text, indent, templates=None):
     """Parses a snippet definition in UltiSnips format from 'text' assuming the
     current 'indent'.
 
     Will instantiate all the objects and link them as children to
-    parent_to. Will also put the initial text into Vim.
+    parent_to. Will also put the initial text into Vim. The parsed tokens
+    are cached in 'templates' if it is given.
 
     """
     all_tokens, seen_ts = tokenize_snippet_text(
@@ -80,6 +81,7 @@ def parse_and_instantiate(parent_to, text, indent):
         __ALLOWED_TOKENS,
         __ALLOWED_TOKENS,
         _TOKEN_TO_TEXTOBJECT,
+        templates,
     )
     resolve_ambiguity(all_tokens, seen_ts)
     _create_transformations(all_tokens, seen_ts)
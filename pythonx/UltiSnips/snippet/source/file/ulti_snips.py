@@ -3,7 +3,6 @@
 
 """Parsing of snippet files."""
 
-from collections import defaultdict
 import glob
 import os
 from typing import Set, List
@@ -18,6 +17,7 @@ from UltiSnips.snippet.source.file.common import (
     normalize_file_path,
 )
 from UltiSnips.text import LineIterator, head_tail
+from UltiSnips.text_objects.python_code import PythonGlobals
 
 
 def find_snippet_files(ft, directory: str) -> Set[str]:
@@ -157,7 +157,7 @@ def _parse_snippets_file(data, filename):
 
     """
 
-    python_globals = defaultdict(list)
+    python_globals = PythonGlobals()
     lines = LineIterator(data)
     current_priority = 0
     actions = {}
@@ -14,6 +14,7 @@ from UltiSnips import vim_helper
 from UltiSnips import err_to_scratch_buffer
 from UltiSnips.diff import diff, guess_edit
 from UltiSnips.position import Position, JumpDirection
+from UltiSnips.position_marks import create_position_marks
 from UltiSnips.snippet.definition import UltiSnipsSnippetDefinition
 from UltiSnips.snippet.source import (
     AddedSnippetsSource,
@@ -24,6 +25,8 @@ from UltiSnips.snippet.source import (
     find_snippet_files,
 )
 from UltiSnips.text import escape
+from UltiSnips.text_objects.python_code import background_runs_polled
+from UltiSnips.text_objects.shell_code import find_tmp_in_background
 from UltiSnips.vim_state import VimState, VisualContentPreserver
 from UltiSnips.buffer_proxy import use_proxy_buffer, suspend_proxy_edits
 
@@ -54,6 +57,22 @@ def _show_user_warning(msg):
     vim_helper.command("echohl None")
 
 
+def _edit_is_inside(snippet, edit):
+    """True if the edit command 'edit' only touches text strictly inside of
+    'snippet'. All text objects around 'snippet' then contain the edit as
+    well, so replaying it from 'snippet' or from the outermost snippet gives
+    the same result."""
+    ctype, line, col, text = edit
+    start = Position(line, col)
+    if ctype == "I":
+        end = start
+    elif text == "\n":
+        end = Position(line + 1, 0)
+    else:
+        end = start + Position(0, len(text))
+    return snippet.start < start and end < snippet.end
+
+
 def _ask_snippets(snippets):
     """Given a list of snippets, ask the user which one they want to use, and
     return it."""
@@ -141,9 +160,16 @@ class SnippetManager:
         if enable_snipmate == "1":
             self.register_snippet_source("snipmate_files", SnipMateFileSource())
 
+        self._track_positions_with_marks = (
+            vim_helper.eval("get(g:, 'UltiSnipsTrackPositionsWithMarks', 0)") == "1"
+        )
+
         self._should_update_textobjects = False
         self._should_reset_visual = False
 
+        if vim_helper.eval("get(g:, 'UltiSnipsShellFindTmpAtStartup', 0)") == "1":
+            find_tmp_in_background()
+
         self._reinit()
 
     @err_to_scratch_buffer.wrap
@@ -359,55 +385,17 @@ class SnippetManager:
             self._ignore_movements = False
             return
 
-        if self._active_snippets:
-            cstart = self._active_snippets[0].start.line
-            cend = (
-                self._active_snippets[0].end.line + self._vstate.diff_in_buffer_length
-            )
-            ct = vim_helper.buf[cstart : cend + 1]
-            lt = self._vstate.remembered_buffer
-            pos = vim_helper.buf.cursor
-
-            lt_span = [0, len(lt)]
-            ct_span = [0, len(ct)]
-            initial_line = cstart
-
-            # Cut down on lines searched for changes. Start from behind and
-            # remove all equal lines. Then do the same from the front.
-            if lt and ct:
-                while (
-                    lt[lt_span[1] - 1] == ct[ct_span[1] - 1]
-                    and self._vstate.ppos.line < initial_line + lt_span[1] - 1
-                    and pos.line < initial_line + ct_span[1] - 1
-                    and (lt_span[0] < lt_span[1])
-                    and (ct_span[0] < ct_span[1])
-                ):
-                    ct_span[1] -= 1
-                    lt_span[1] -= 1
-                while (
-                    lt_span[0] < lt_span[1]
-                    and ct_span[0] < ct_span[1]
-                    and lt[lt_span[0]] == ct[ct_span[0]]
-                    and self._vstate.ppos.line >= initial_line
-                    and pos.line >= initial_line
-                ):
-                    ct_span[0] += 1
-                    lt_span[0] += 1
-                    initial_line += 1
-            ct_span[0] = max(0, ct_span[0] - 1)
-            lt_span[0] = max(0, lt_span[0] - 1)
-            initial_line = max(cstart, initial_line - 1)
-
-            lt = lt[lt_span[0] : lt_span[1]]
-            ct = ct[ct_span[0] : ct_span[1]]
+        if self._active_snippets and not self._vstate.buffer_changed:
+            # Only the cursor moved, nothing to replay or update.
+            self._check_if_still_inside_snippet()
+            return
 
+        if self._active_snippets:
             try:
-                rv, es = guess_edit(initial_line, lt, ct, self._vstate)
-                if not rv:
-                    lt = "\n".join(lt)
-                    ct = "\n".join(ct)
-                    es = diff(lt, ct, initial_line)
-                self._active_snippets[0].replay_user_edits(es, self._ctab)
+                es = self._vstate.reported_edits()
+                if es is None:
+                    es = self._guess_user_edits()
+                self._replay_user_edits(es)
             except IndexError:
                 # Rather do nothing than throwing an error. It will be correct
                 # most of the time
@@ -415,8 +403,91 @@ class SnippetManager:
 
         self._check_if_still_inside_snippet()
         if self._active_snippets:
-            self._active_snippets[0].update_textobjects(vim_helper.buf)
-            self._vstate.remember_buffer(self._active_snippets[0])
+            snippet = self._active_snippets[0]
+            with vim_helper.shadow_buffer(snippet.start.line, snippet.end.line):
+                snippet.update_textobjects(vim_helper.buf)
+                self._vstate.remember_buffer(snippet)
+
+    @err_to_scratch_buffer.wrap
+    def _background_runs_poll(self):
+        """Called by a timer while python code runs in the background. Updates
+        the snippet to pick up the results of the runs that are done."""
+        background_runs_polled()
+        if not self._active_snippets or self._vstate.buffer_changed:
+            # The next cursor movement updates the snippet.
+            return
+        snippet = self._active_snippets[0]
+        with vim_helper.shadow_buffer(snippet.start.line, snippet.end.line):
+            snippet.update_textobjects(vim_helper.buf)
+            self._vstate.remember_buffer(snippet)
+        vim_helper.command("redraw")
+
+    def _replay_user_edits(self, edits):
+        """Replays 'edits' in the snippets. With nested snippets, each edit is
+        replayed from the innermost snippet that contains it, so that only
+        the text objects around it are looked at. Changes of its span are
+        passed up to the outer snippets."""
+        if len(self._active_snippets) == 1:
+            self._active_snippets[0].replay_user_edits(edits, self._ctab)
+            return
+        for edit in edits:
+            snippet = self._active_snippets[0]
+            for inner in reversed(self._active_snippets[1:]):
+                if _edit_is_inside(inner, edit):
+                    snippet = inner
+                    break
+            snippet.replay_user_edits([edit], self._ctab)
+
+    def _guess_user_edits(self):
+        """Guesses the edits the user has done inside the outermost snippet by
+        comparing the buffer with the remembered buffer."""
+        cstart = self._active_snippets[0].start.line
+        cend = (
+            self._active_snippets[0].end.line + self._vstate.diff_in_buffer_length
+        )
+        ct = vim_helper.buf[cstart : cend + 1]
+        lt = self._vstate.remembered_buffer
+        pos = vim_helper.buf.cursor
+
+        lt_span = [0, len(lt)]
+        ct_span = [0, len(ct)]
+        initial_line = cstart
+
+        # Cut down on lines searched for changes. Start from behind and
+        # remove all equal lines. Then do the same from the front.
+        if lt and ct:
+            while (
+                lt[lt_span[1] - 1] == ct[ct_span[1] - 1]
+                and self._vstate.ppos.line < initial_line + lt_span[1] - 1
+                and pos.line < initial_line + ct_span[1] - 1
+                and (lt_span[0] < lt_span[1])
+                and (ct_span[0] < ct_span[1])
+            ):
+                ct_span[1] -= 1
+                lt_span[1] -= 1
+            while (
+                lt_span[0] < lt_span[1]
+                and ct_span[0] < ct_span[1]
+                and lt[lt_span[0]] == ct[ct_span[0]]
+                and self._vstate.ppos.line >= initial_line
+                and pos.line >= initial_line
+            ):
+                ct_span[0] += 1
+                lt_span[0] += 1
+                initial_line += 1
+        ct_span[0] = max(0, ct_span[0] - 1)
+        lt_span[0] = max(0, lt_span[0] - 1)
+        initial_line = max(cstart, initial_line - 1)
+
+        lt = lt[lt_span[0] : lt_span[1]]
+        ct = ct[ct_span[0] : ct_span[1]]
+
+        rv, es = guess_edit(initial_line, lt, ct, self._vstate)
+        if not rv:
+            lt = "\n".join(lt)
+            ct = "\n".join(ct)
+            es = diff(lt, ct, initial_line)
+        return es
 
     def _setup_inner_state(self):
         """Map keys and create autocommands that should only be defined when a
@@ -462,6 +533,8 @@ class SnippetManager:
 
         vim_helper.command("augroup END")
 
+        self._vstate.listen_for_edits()
+
         vim_helper.command(
             "silent doautocmd <nomodeline> User UltiSnipsEnterFirstSnippet"
         )
@@ -472,6 +545,7 @@ class SnippetManager:
         if not self._inner_state_up:
             return
         try:
+            self._vstate.stop_listening_for_edits()
             vim_helper.command(
                 "silent doautocmd <nomodeline> User UltiSnipsExitLastSnippet"
             )
@@ -530,8 +604,9 @@ class SnippetManager:
 
     def _current_snippet_is_done(self):
         """The current snippet should be terminated."""
-        self._active_snippets.pop()
+        snippet = self._active_snippets.pop()
         if not self._active_snippets:
+            snippet.stop_tracking_positions()
             self._teardown_inner_state()
 
     def _jump(self, jump_direction: JumpDirection):
@@ -587,7 +662,11 @@ class SnippetManager:
                         self._visual_content.placeholder
                     )
                     self._should_reset_visual = False
-                    self._active_snippets[0].update_textobjects(vim_helper.buf)
+                    snippet = self._active_snippets[0]
+                    with vim_helper.shadow_buffer(
+                        snippet.start.line, snippet.end.line
+                    ):
+                        snippet.update_textobjects(vim_helper.buf)
                     # Open any folds this might have created
                     vim_helper.command("normal! zv")
                     self._vstate.remember_buffer(self._active_snippets[0])
@@ -608,7 +687,11 @@ class SnippetManager:
                 if not ntab_short_and_near:
                     self._ignore_movements = True
 
-            if len(stack_for_post_jump) > 0 and ntab is not None:
+            if (
+                len(stack_for_post_jump) > 0
+                and ntab is not None
+                and snippet_for_action.snippet.has_action("post_jump")
+            ):
                 with use_proxy_buffer(stack_for_post_jump, self._vstate):
                     snippet_for_action.snippet.do_post_jump(
                         ntab.number,
@@ -726,11 +809,13 @@ class SnippetManager:
         if snippet.matched:
             text_before = before[: -len(snippet.matched)]
 
-        with use_proxy_buffer(self._active_snippets, self._vstate):
-            with self._action_context():
-                cursor_set_in_action = snippet.do_pre_expand(
-                    self._visual_content.text, self._active_snippets
-                )
+        cursor_set_in_action = False
+        if snippet.has_action("pre_expand"):
+            with use_proxy_buffer(self._active_snippets, self._vstate):
+                with self._action_context():
+                    cursor_set_in_action = snippet.do_pre_expand(
+                        self._visual_content.text, self._active_snippets
+                    )
 
         if cursor_set_in_action:
             text_before = vim_helper.buf.line_till_cursor
@@ -764,14 +849,17 @@ class SnippetManager:
 
             self._visual_content.reset()
             self._active_snippets.append(snippet_instance)
-
-            with use_proxy_buffer(self._active_snippets, self._vstate):
-                with self._action_context():
-                    snippet.do_post_expand(
-                        snippet_instance.start,
-                        snippet_instance.end,
-                        self._active_snippets,
-                    )
+            if len(self._active_snippets) == 1 and self._track_positions_with_marks:
+                snippet_instance.track_positions_with(create_position_marks())
+
+            if snippet.has_action("post_expand"):
+                with use_proxy_buffer(self._active_snippets, self._vstate):
+                    with self._action_context():
+                        snippet.do_post_expand(
+                            snippet_instance.start,
+                            snippet_instance.end,
+                            self._active_snippets,
+                        )
 
             self._vstate.remember_buffer(self._active_snippets[0])
 
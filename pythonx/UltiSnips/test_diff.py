@@ -5,7 +5,7 @@
 
 import unittest
 
-from diff import diff, guess_edit
+from diff import diff, edits_from_changed_lines, guess_edit
 from position import Position
 from typing import List
 
@@ -171,6 +171,78 @@ class MultiLine(_Base, unittest.TestCase):
     )
 
 
+class _BaseChangedLines:
+    def runTest(self):
+        es = edits_from_changed_lines(
+            self.initial_line, self.a, self.b, Position(*self.pos)
+        )
+        a = "\n".join([""] * self.initial_line + self.a)
+        b = "\n".join([""] * self.initial_line + self.b)
+        self.assertEqual(b, transform(a, es))
+        self.assertEqual(self.wanted, es)
+
+
+class ChangedLines_InsertOneChar(_BaseChangedLines, unittest.TestCase):
+    a, b = ["Hello  World"], ["Hello   World"]
+    initial_line = 0
+    pos = (0, 7)
+    wanted = (("I", 0, 6, " "),)
+
+
+class ChangedLines_InsertOneCharBeforeCursor(_BaseChangedLines, unittest.TestCase):
+    a, b = ["Hello  World"], ["Hello   World"]
+    initial_line = 0
+    pos = (0, 8)
+    wanted = (("I", 0, 7, " "),)
+
+
+class ChangedLines_Backspace(_BaseChangedLines, unittest.TestCase):
+    a, b = ["Hello  World"], ["Hello World"]
+    initial_line = 2
+    pos = (2, 6)
+    wanted = (("D", 2, 6, " "),)
+
+
+class ChangedLines_CarriageReturn(_BaseChangedLines, unittest.TestCase):
+    a, b = ["Hello World"], ["Hello", " World"]
+    initial_line = 1
+    pos = (2, 0)
+    wanted = (("I", 1, 5, "\n"),)
+
+
+class ChangedLines_JoinLines(_BaseChangedLines, unittest.TestCase):
+    a, b = ["Hello", "World"], ["HelloWorld"]
+    initial_line = 0
+    pos = (0, 5)
+    wanted = (("D", 0, 5, "\n"),)
+
+
+class ChangedLines_ReplaceOverLines(_BaseChangedLines, unittest.TestCase):
+    a, b = ["first line", "second line"], ["first k", "x line"]
+    initial_line = 3
+    pos = (4, 1)
+    wanted = (
+        ("D", 3, 6, "line"),
+        ("D", 3, 6, "\n"),
+        ("D", 3, 6, "second"),
+        ("I", 3, 6, "k"),
+        ("I", 3, 7, "\n"),
+        ("I", 4, 0, "x"),
+    )
+
+
+class ChangedLines_SubstituteSeveralTimes(_BaseChangedLines, unittest.TestCase):
+    a, b = ["foo bar foo"], ["baz bar baz"]
+    initial_line = 0
+    pos = (0, 0)
+    wanted = (
+        ("D", 0, 0, "foo"),
+        ("I", 0, 0, "baz"),
+        ("D", 0, 8, "foo"),
+        ("I", 0, 8, "baz"),
+    )
+
+
 if __name__ == "__main__":
     unittest.main()
     # k = TestEditScript()
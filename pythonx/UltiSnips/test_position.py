@@ -5,7 +5,7 @@
 
 import unittest
 
-from position import Position
+from position import Position, RelativePosition
 
 
 class _MPBase:
@@ -67,5 +67,41 @@ class MovePosition_DelSecondLine1(_MPBase, unittest.TestCase):
     )
 
 
+class _RPBase:
+    # Moving only the anchor must move the position like move() would.
+    def runTest(self):
+        anchor = RelativePosition(None, *self.anchor)
+        obj = RelativePosition(anchor, *self.obj)
+        for pivot, delta in self.steps:
+            wanted = Position(obj.line, obj.col)
+            wanted.move(Position(*pivot), Position(*delta))
+            anchor.move(Position(*pivot), Position(*delta))
+            self.assertEqual(wanted, obj)
+
+
+class RelativePosition_SameLine(_RPBase, unittest.TestCase):
+    anchor = (0, 2)
+    obj = (0, 5)
+    steps = (((0, 1), (0, 3)), ((0, 0), (0, -1)), ((0, 4), (1, 0)))
+
+
+class RelativePosition_LaterLine(_RPBase, unittest.TestCase):
+    anchor = (0, 2)
+    obj = (2, 1)
+    steps = (((0, 1), (0, 3)), ((0, 2), (1, 0)), ((0, 7), (-1, 0)))
+
+
+class RelativePosition_SetAbsolute(unittest.TestCase):
+    def runTest(self):
+        anchor = RelativePosition(None, 1, 4)
+        obj = RelativePosition(anchor, 1, 6)
+        obj.line, obj.col = 2, 3
+        anchor.col = 0
+        self.assertEqual(Position(2, 3), obj)
+        obj.line = 1
+        anchor.col = 2
+        self.assertEqual(Position(1, 5), obj)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,8 +3,10 @@
 
 """Base classes for all text objects."""
 
+from bisect import bisect_left, insort
+
 from UltiSnips import vim_helper
-from UltiSnips.position import Position
+from UltiSnips.position import Position, RelativePosition
 
 
 def _calc_end(text, start):
@@ -36,6 +38,40 @@ def _replace_text(buf, start, end, text):
     return new_end
 
 
+def _children_around(children, start, end):
+    """Returns the range of indices into the sorted 'children' that might
+    touch the span 'start' to 'end', i.e. that do not end before 'start' and do
+    not start after 'end'.
+
+    Siblings that span text never overlap, so their ends are sorted just like
+    their starts and both bounds can be bisected. Zero-width children (empty
+    tabstops, the _VimCursor) can sit inside or at the end of a sibling and
+    break that order, so the lower bound is widened over them until a child
+    that spans text and ends before 'start' is found."""
+    lo, hi = 0, len(children)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if children[mid]._end < start:
+            lo = mid + 1
+        else:
+            hi = mid
+    first = lo
+    for idx in range(first - 1, -1, -1):
+        child = children[idx]
+        if child._end >= start:
+            first = idx
+        elif child._start != child._end:
+            break
+    hi = len(children)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if end < children[mid]._start:
+            hi = mid
+        else:
+            lo = mid + 1
+    return range(first, lo)
+
+
 # These classes use their subclasses a lot and we really do not want to expose
 # their functions more globally.
 # pylint: disable=protected-access
@@ -50,14 +86,16 @@ class TextObject:
     ):
         self._parent = parent
 
-        if end is not None:  # Took 4 arguments
-            self._start = token_or_start
-            self._end = end
-            self._initial_text = initial_text
-        else:  # Initialize from token
-            self._start = token_or_start.start
-            self._end = token_or_start.end
-            self._initial_text = token_or_start.initial_text
+        if end is None:  # Initialize from token
+            end = token_or_start.end
+            initial_text = token_or_start.initial_text
+            token_or_start = token_or_start.start
+        # Our positions are relative to the start of our parent, so that they
+        # move along with it.
+        anchor = parent._start if parent is not None else None
+        self._start = RelativePosition(anchor, token_or_start.line, token_or_start.col)
+        self._end = RelativePosition(anchor, end.line, end.col)
+        self._initial_text = initial_text
         self._tiebreaker = tiebreaker or Position(self._start.line, self._end.line)
         if parent is not None:
             parent._add_child(self)
@@ -142,13 +180,14 @@ class TextObject:
         # not want to mess with their positions
         if self.current_text == gtext:
             return
-        old_end = self._end
-        self._end = _replace_text(buf, self._start, self._end, gtext)
+        old_end = Position(self._end.line, self._end.col)
+        new_end = _replace_text(buf, self._start, self._end, gtext)
+        self._end.line, self._end.col = new_end.line, new_end.col
         if self._parent:
             self._parent._child_has_moved(
-                self._parent._children.index(self),
-                min(old_end, self._end),
-                self._end.delta(old_end),
+                self._parent._index_of_child(self),
+                min(old_end, new_end),
+                new_end.delta(old_end),
             )
 
     def _update(self, done, buf):
@@ -160,6 +199,16 @@ class TextObject:
         """
         raise NotImplementedError("Must be implemented by subclasses.")
 
+    def _update_dependencies(self):
+        """Returns the text objects that must be updated before this one."""
+        return ()
+
+    def _update_hints(self):
+        """Returns (before, after): text objects that should be updated before
+        and after this one if that is possible without a cycle. Unlike
+        _update_dependencies(), these can change with every update."""
+        return (), ()
+
 
 class EditableTextObject(TextObject):
 
@@ -191,7 +240,10 @@ class EditableTextObject(TextObject):
     ####################
     def find_parent_for_new_to(self, pos):
         """Figure out the parent object for something at 'pos'."""
-        for children in self._editable_children:
+        for idx in _children_around(self._children, pos, pos):
+            children = self._children[idx]
+            if not isinstance(children, EditableTextObject):
+                continue
             if children._start <= pos < children._end:
                 return children.find_parent_for_new_to(pos)
             if children._start == pos and pos == children._end:
@@ -207,9 +259,17 @@ class EditableTextObject(TextObject):
         assert ("\n" not in text) or (text == "\n")
         pos = Position(line, col)
 
+        if ctype == "I":
+            last = pos
+        elif text == "\n":
+            last = Position(line + 1, 0)
+        else:
+            last = pos + Position(0, len(text))
+        candidates = _children_around(self._children, pos, last)
+
         to_kill = set()
         new_cmds = []
-        for child in self._children:
+        for child in (self._children[idx] for idx in candidates):
             if ctype == "I":  # Insertion
                 if child._start < pos < Position(
                     child._end.line, child._end.col
@@ -284,20 +344,16 @@ class EditableTextObject(TextObject):
             delta.col *= -1
         pivot = Position(line, col)
         idx = -1
-        for cidx, child in enumerate(self._children):
+        for cidx in candidates:
+            child = self._children[cidx]
             if child._start < pivot <= child._end:
                 idx = cidx
         self._child_has_moved(idx, pivot, delta)
 
-    def _move(self, pivot, diff):
-        TextObject._move(self, pivot, diff)
-
-        for child in self._children:
-            child._move(pivot, diff)
-
     def _child_has_moved(self, idx, pivot, diff):
         """Called when a the child with 'idx' has moved behind 'pivot' by
-        'diff'."""
+        'diff'. The children of the moved siblings are relative to their start
+        and move along with it."""
         self._end.move(pivot, diff)
 
         for child in self._children[idx + 1 :]:
@@ -305,9 +361,18 @@ class EditableTextObject(TextObject):
 
         if self._parent:
             self._parent._child_has_moved(
-                self._parent._children.index(self), pivot, diff
+                self._parent._index_of_child(self), pivot, diff
             )
 
+    def _index_of_child(self, child):
+        """Returns the index of 'child' in our sorted children."""
+        idx = bisect_left(self._children, child)
+        while idx < len(self._children) and self._children[idx] is not child:
+            idx += 1
+        if idx == len(self._children):
+            return self._children.index(child)
+        return idx
+
     def _get_next_tab(self, number):
         """Returns the next tabstop after 'number'."""
         if not len(self._tabstops.keys()):
@@ -379,10 +444,19 @@ class EditableTextObject(TextObject):
             done.add(self)
         return True
 
+    def _update_hints(self):
+        # Our text is only final when the text of our children is.
+        return self._children, ()
+
     def _add_child(self, child):
         """Add 'child' as a new child of this text object."""
-        self._children.append(child)
-        self._children.sort()
+        insort(self._children, child)
+        self._child_was_added()
+
+    def _child_was_added(self):
+        """Called when a new text object was added somewhere below us."""
+        if self._parent:
+            self._parent._child_was_added()
 
     def _del_child(self, child):
         """Delete this 'child'."""
@@ -13,6 +13,8 @@ class Mirror(NoneditableTextObject):
     def __init__(self, parent, tabstop, token):
         NoneditableTextObject.__init__(self, parent, token)
         self._ts = tabstop
+        self._last_input = None
+        self._last_output = None
 
     def _update(self, done, buf):
         if self._ts.is_killed:
@@ -23,9 +25,19 @@ class Mirror(NoneditableTextObject):
         if self._ts not in done:
             return False
 
+        # Nothing to do if neither our tabstop nor our own text changed.
+        text = self._ts.current_text
+        if text == self._last_input and self.current_text == self._last_output:
+            return True
+
         self.overwrite(buf, self._get_text())
+        self._last_input = text
+        self._last_output = self.current_text
         return True
 
+    def _update_dependencies(self):
+        return (self._ts,)
+
     def _get_text(self):
         """Returns the text used for mirroring.
 
@@ -3,13 +3,19 @@
 
 """Implements `!p ` interpolation."""
 
+import ast
+import builtins
+import copy
 import os
-from collections import namedtuple
+import threading
+import types
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 
 from UltiSnips import vim_helper
 from UltiSnips.indent_util import IndentUtil
 from UltiSnips.text_objects.base import NoneditableTextObject
-from UltiSnips.vim_state import _Placeholder
+from UltiSnips.vim_state import _Placeholder, vim_snapshot
 import UltiSnips.snippet_manager
 
 
@@ -17,23 +23,313 @@ class _Tabs:
 
     """Allows access to tabstop content via t[] inside of python code."""
 
-    def __init__(self, to):
+    def __init__(self, to, read=None, written=None):
         self._to = to
+        self._read = read if read is not None else []
+        self._written = written if written is not None else []
 
     def __getitem__(self, no):
         ts = self._to._get_tabstop(self._to, int(no))  # pylint:disable=protected-access
         if ts is None:
             return ""
+        self._read.append(ts)
         return ts.current_text
 
     def __setitem__(self, no, value):
         ts = self._to._get_tabstop(self._to, int(no))  # pylint:disable=protected-access
         if ts is None:
             return
+        self._written.append(ts)
         # TODO(sirver): The buffer should be passed into the object on construction.
         ts.overwrite(vim_helper.buf, value)
 
 
+class _TabsSnapshot:
+
+    """Like _Tabs, but returns the text the tabstops had when it was created.
+    Python code that runs in the background reads from this, it must not ask
+    Vim."""
+
+    def __init__(self, to, snippet):
+        # pylint:disable=protected-access
+        numbers = set()
+
+        def _collect(obj):
+            """Collects the tabstop numbers of 'obj' and its children."""
+            numbers.update(obj._tabstops)
+            for child in obj._editable_children:
+                _collect(child)
+
+        _collect(snippet)
+        self._tabstops = {}
+        for no in numbers:
+            ts = to._get_tabstop(to, no)
+            if ts is not None:
+                self._tabstops[no] = (ts, ts.current_text)
+        self.read = []
+
+    def __getitem__(self, no):
+        if int(no) not in self._tabstops:
+            return ""
+        ts, text = self._tabstops[int(no)]
+        self.read.append((ts, text))
+        return text
+
+    def __setitem__(self, no, value):
+        raise RuntimeError(
+            "t[%s] can not be set by python code that runs in the background." % no
+        )
+
+
+# Locals that every PythonCode sets before it runs.
+_PER_RUN_LOCALS = ("t", "fn", "path", "cur", "res", "snip")
+
+
+def _data_locals(local_vars):
+    """Returns the variables in 'local_vars' that python code can pass on to
+    the python code that runs after it. Functions and modules are redefined by
+    every run and are left out."""
+    return {
+        name: value
+        for name, value in local_vars.items()
+        if name not in _PER_RUN_LOCALS
+        and not name.startswith("__")
+        and not callable(value)
+        and not isinstance(value, types.ModuleType)
+    }
+
+
+# The locals of the python code that runs in each thread, innermost last.
+_running = threading.local()
+
+
+@contextmanager
+def running_in(local_vars):
+    """Makes the names of 'local_vars' visible to the code of the `global !p`
+    blocks while python code runs in 'local_vars' in this thread."""
+    runs = getattr(_running, "runs", None)
+    if runs is None:
+        runs = _running.runs = []
+    runs.append(local_vars)
+    try:
+        yield
+    finally:
+        runs.pop()
+
+
+class _GlobalNamespace(dict):
+
+    """The namespace the `global !p` blocks run in. Names that the blocks do
+    not define are looked up in the locals of the python code that is running,
+    so that their functions and classes see 'snip', 't' and the other names of
+    the run that uses them."""
+
+    def __missing__(self, name):
+        runs = getattr(_running, "runs", None)
+        if not runs:
+            raise KeyError(name)
+        return runs[-1][name]
+
+
+def _run_global_code(code):
+    """Returns a new namespace that 'code' of the `global !p` blocks and the
+    default imports ran in."""
+    code = "import re, os, vim, string, random\n" + code
+    namespace = _GlobalNamespace()
+    try:
+        exec(code, namespace)  # pylint:disable=exec-used
+    except Exception as exception:
+        exception.snippet_code = code
+        raise
+    return namespace
+
+
+class PythonGlobals(defaultdict):
+
+    """The `global` blocks of a snippet file by their type.
+
+    The `!p` blocks run only once into a namespace that all python code of
+    the snippets of the file builds on. Reloading the file creates a new
+    instance, so they run again then.
+
+    """
+
+    def __init__(self):
+        defaultdict.__init__(self, list)
+        self._blocks = 0
+        self._namespace = None
+
+    def namespace(self):
+        """The namespace the `!p` blocks ran in."""
+        blocks = self.get("!p", ())
+        # Blocks are only ever added, while the file is parsed, so their
+        # number tells if the namespace has all of them.
+        if self._namespace is None or len(blocks) != self._blocks:
+            self._namespace = _run_global_code("\n".join(blocks).replace("\r\n", "\n"))
+            self._blocks = len(blocks)
+        return self._namespace
+
+
+def python_globals_namespace(python_globals):
+    """The namespace the `!p` blocks of 'python_globals' ran in. Plain dicts,
+    as used for snippets that are not from a file, run them every time."""
+    if isinstance(python_globals, PythonGlobals):
+        return python_globals.namespace()
+    return _run_global_code(
+        "\n".join(python_globals.get("!p", [])).replace("\r\n", "\n")
+    )
+
+
+def layer_on_globals(python_globals, local_vars):
+    """Puts the names of the `!p` blocks of 'python_globals' into 'local_vars'
+    which python code then runs in. The namespace that all snippets of the
+    file share is left alone; code from the blocks sees the names of a run,
+    like 'snip' and 't', while the run is inside running_in()."""
+    local_vars.update(python_globals_namespace(python_globals))
+    return local_vars
+
+
+# How long to wait for python code that runs in the background before the
+# snippet is updated without its result, if 'snip.background' is True.
+_BACKGROUND_BUDGET = 0.05
+
+# How often to check if python code that runs in the background is done.
+_BACKGROUND_POLL_MS = 20
+
+# Attributes of 'snip' that ask Vim.
+_VIM_SNIP_ATTRIBUTES = frozenset(("fn", "basename", "ft", "opt", "buffer"))
+
+_poll_scheduled = False  # pylint:disable=invalid-name
+_has_timers = None  # pylint:disable=invalid-name
+
+
+# Names whose functions python code can call in the background: the modules
+# it is given and the names of its run. Functions from anywhere else, e.g. the
+# `global !p` blocks, might use Vim.
+_BACKGROUND_CALLABLE = frozenset(("re", "os", "string", "random") + _PER_RUN_LOCALS)
+
+
+def _defined_names(tree):
+    """The names that the code in 'tree' defines itself."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split(".")[0])
+    return names
+
+
+def _called_name(node):
+    """The name that the function of the call 'node' is looked up through,
+    e.g. 'a' for 'a.b[1].c()'. None if it is not looked up through a name,
+    e.g. for '"".join()'."""
+    func = node.func
+    while isinstance(func, (ast.Attribute, ast.Subscript, ast.Call)):
+        func = func.func if isinstance(func, ast.Call) else func.value
+    return func.id if isinstance(func, ast.Name) else None
+
+
+def _uses_vim(code):
+    """True if 'code' uses Vim, writes tabstops or calls functions that it
+    did not define itself, as far as we can tell."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return True
+    callable_names = _defined_names(tree) | _BACKGROUND_CALLABLE | set(dir(builtins))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "vim":
+            return True
+        if isinstance(node, ast.Call):
+            name = _called_name(node)
+            if name is not None and name not in callable_names:
+                return True
+            continue
+        if not isinstance(node, (ast.Attribute, ast.Subscript)):
+            continue
+        if not isinstance(node.value, ast.Name):
+            continue
+        if isinstance(node, ast.Attribute):
+            if node.value.id == "snip" and node.attr in _VIM_SNIP_ATTRIBUTES:
+                return True
+        elif node.value.id == "t" and isinstance(node.ctx, ast.Store):
+            return True
+    return False
+
+
+def _can_run_in_background():
+    """True if Vim has timers to pick up the results of background runs."""
+    global _has_timers  # pylint:disable=global-statement,invalid-name
+    if _has_timers is None:
+        _has_timers = vim_helper.eval("has('timers')") == "1"
+    return _has_timers
+
+
+def _poll_background_runs():
+    """Makes sure that a timer checks for finished background runs soon."""
+    global _poll_scheduled  # pylint:disable=global-statement,invalid-name
+    if not _poll_scheduled:
+        vim_helper.eval(
+            "timer_start(%i, 'UltiSnips#BackgroundRunsPoll')" % _BACKGROUND_POLL_MS
+        )
+        _poll_scheduled = True
+
+
+def background_runs_polled():
+    """Called when the timer of _poll_background_runs() fired."""
+    global _poll_scheduled  # pylint:disable=global-statement,invalid-name
+    _poll_scheduled = False
+
+
+class _BackgroundRun(threading.Thread):
+
+    """Runs the code of a PythonCode in a thread. Everything it needs from
+    Vim is collected before it starts."""
+
+    def __init__(self, code, local_vars, tabs, path, ct, placeholder):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._code = code
+        self.locals = local_vars
+        self.initial_locals = _data_locals(local_vars)
+        self.tabs = tabs
+        self.path = path
+        self.ct = ct
+        self.placeholder = placeholder
+        self.rv = None
+        self.exception = None
+
+    @property
+    def snip(self):
+        """The 'snip' object of this run."""
+        return self.locals["snip"]
+
+    def run(self):
+        try:
+            with running_in(self.locals):
+                exec(self._code, self.locals)  # pylint:disable=exec-used
+            self.rv = str(
+                self.snip.rv if self.snip._rv_changed else self.locals["res"]
+            )  # pylint:disable=protected-access
+        except Exception as exception:  # pylint:disable=broad-except
+            exception.snippet_code = self._code
+            self.exception = exception
+
+    def changed_locals(self):
+        """The variables the code has set."""
+        return {
+            name: value
+            for name, value in _data_locals(self.locals).items()
+            if name not in self.initial_locals
+            or self.initial_locals[name] is not value
+        }
+
+
 _VisualContent = namedtuple("_VisualContent", ["mode", "text"])
 
 
@@ -56,7 +352,7 @@ class SnippetUtil:
     """
 
     def __init__(self, initial_indent, vmode, vtext, context, parent):
-        self._ind = IndentUtil()
+        self._ind = IndentUtil(vim_snapshot().indent)
         self._visual = _VisualContent(vmode, vtext)
         self._initial_indent = self._ind.indent_to_spaces(initial_indent)
         self._reset("")
@@ -71,10 +367,12 @@ class SnippetUtil:
         :cur: the new value for c.
 
         """
-        self._ind.reset()
+        self._ind.reset(vim_snapshot().indent)
         self._cur = cur
         self._rv = ""
         self._changed = False
+        self.volatile = False
+        self.background = False
         self.reset_indent()
 
     def shift(self, amount=1):
@@ -128,12 +426,12 @@ class SnippetUtil:
     @property
     def fn(self):  # pylint:disable=no-self-use,invalid-name
         """The filename."""
-        return vim_helper.eval('expand("%:t")') or ""
+        return vim_snapshot().file[1] or ""
 
     @property
     def basename(self):  # pylint:disable=no-self-use
         """The filename without extension."""
-        return vim_helper.eval('expand("%:t:r")') or ""
+        return vim_snapshot().file[2] or ""
 
     @property
     def ft(self):  # pylint:disable=invalid-name
@@ -182,11 +480,9 @@ class SnippetUtil:
 
     def opt(self, option, default=None):  # pylint:disable=no-self-use
         """Gets a Vim variable."""
-        if vim_helper.eval("exists('%s')" % option) == "1":
-            try:
-                return vim_helper.eval(option)
-            except vim_helper.error:
-                pass
+        value = vim_snapshot().opt(option)
+        if value:
+            return value[0]
         return default
 
     def __add__(self, value):
@@ -241,19 +537,151 @@ class PythonCode(NoneditableTextObject):
                 snippet = snippet._parent  # pylint:disable=protected-access
         self._snip = SnippetUtil(token.indent, mode, text, context, snippet)
 
-        self._codes = (
-            "import re, os, vim, string, random",
-            "\n".join(snippet.globals.get("!p", [])).replace("\r\n", "\n"),
-            token.code.replace("\\`", "`"),
-        )
+        self._globals = snippet.globals
+        self._code = token.code.replace("\\`", "`")
+        self._tabstops_read = []
+        self._tabstops_written = []
+        self._inputs = None
+        self._background_budget = None
+        self._background_run = None
+        self._uses_vim = None
         NoneditableTextObject.__init__(self, parent, token)
 
+    def _current_inputs(self, path, ct):
+        """Returns everything our last run depended on, as far as we can
+        tell."""
+        tabstops = []
+        for ts in self._tabstops_read + self._tabstops_written:
+            if ts.is_killed:
+                return None
+            tabstops.append((ts, ts.current_text))
+        return (
+            path,
+            ct,
+            self._snip._parent.current_placeholder,  # pylint:disable=protected-access
+            tabstops,
+            _data_locals(self._locals),
+        )
+
+    def _inputs_unchanged(self, path, ct):
+        """True if running the code again would see the same inputs as the
+        last time."""
+        if self._inputs is None or self._snip.volatile:
+            return False
+        try:
+            return self._current_inputs(path, ct) == self._inputs
+        except Exception:  # pylint:disable=broad-except
+            # Locals that cannot be compared, just run the code.
+            return False
+
+    def _declared_budget(self, snip):
+        """How long to wait for the next run if 'snip' of the last run asked
+        to run in the background, None if the code runs in the foreground."""
+        if not snip.background or not _can_run_in_background():
+            return None
+        if self._uses_vim is None:
+            self._uses_vim = _uses_vim(self._code)
+            if self._uses_vim:
+                vim_helper.command("echohl WarningMsg")
+                vim_helper.command(
+                    'echom "UltiSnips: python code that uses vim or functions '
+                    "it does not define can not run in the background, it "
+                    'runs in the foreground instead."'
+                )
+                vim_helper.command("echohl None")
+        if self._uses_vim:
+            return None
+        if snip.background is True:
+            return _BACKGROUND_BUDGET
+        return float(snip.background)
+
+    def _start_background_run(self, buf, path, ct):
+        """Runs the code in a thread and waits for it as long as the budget
+        allows. If it takes longer, our text stays as it is until a timer
+        finds the run done."""
+        snip = copy.copy(self._snip)
+        snip._reset(ct)  # pylint:disable=protected-access
+        tabs = _TabsSnapshot(self._parent, self._snip._parent)
+        local_vars = dict(self._locals)
+        local_vars.update(
+            {
+                "t": tabs,
+                "fn": os.path.basename(path),
+                "path": path,
+                "cur": ct,
+                "res": ct,
+                "snip": snip,
+            }
+        )
+        layer_on_globals(self._globals, local_vars)
+
+        self._background_run = _BackgroundRun(
+            self._code,
+            local_vars,
+            tabs,
+            path,
+            ct,
+            self._snip._parent.current_placeholder,  # pylint:disable=protected-access
+        )
+        self._background_run.start()
+        self._background_run.join(self._background_budget)
+        if self._background_run.is_alive():
+            _poll_background_runs()
+            return True
+        return self._finish_background_run(buf, path, ct)
+
+    def _finish_background_run(self, buf, path, ct):
+        """Puts the result of the done background run into our text, unless
+        what the code saw has changed since it started. Then we need to run
+        again."""
+        run, self._background_run = self._background_run, None
+        if run.exception is not None:
+            self._inputs = None
+            raise run.exception
+        self._snip.volatile = run.snip.volatile
+        self._background_budget = self._declared_budget(run.snip)
+        self._tabstops_read = [ts for ts, _ in run.tabs.read]
+        self._tabstops_written = []
+        self._locals.update(run.changed_locals())
+
+        inputs = (
+            run.path,
+            run.ct,
+            run.placeholder,
+            run.tabs.read,
+            _data_locals(self._locals),
+        )
+        if self._current_inputs(path, ct) != inputs:
+            self._inputs = None
+            return False
+
+        if ct != run.rv:
+            self.overwrite(buf, run.rv)
+        self._inputs = self._current_inputs(path, run.rv)
+        return True
+
     def _update(self, done, buf):
-        path = vim_helper.eval('expand("%")') or ""
+        path = vim_snapshot().file[0] or ""
         ct = self.current_text
+        if self._background_run is not None:
+            if self._background_run.is_alive():
+                _poll_background_runs()
+                return True
+            return self._finish_background_run(buf, path, ct)
+        if self._inputs_unchanged(path, ct):
+            return True
+        if self._background_budget is not None:
+            return self._start_background_run(buf, path, ct)
+        # The code might look at Vim directly.
+        vim_helper.flush_deferred_writes()
+
+        self._tabstops_read = []
+        self._tabstops_written = []
         self._locals.update(
             {
-                "t": _Tabs(self._parent),
+                "t": _Tabs(
+                    self._parent, self._tabstops_read, self._tabstops_written
+                ),
                 "fn": os.path.basename(path),
                 "path": path,
                 "cur": ct,
@@ -263,18 +691,29 @@ class PythonCode(NoneditableTextObject):
         )
         self._snip._reset(ct)  # pylint:disable=protected-access
 
-        for code in self._codes:
-            try:
-                exec(code, self._locals)  # pylint:disable=exec-used
-            except Exception as exception:
-                exception.snippet_code = code
-                raise
+        layer_on_globals(self._globals, self._locals)
+        try:
+            with running_in(self._locals):
+                exec(self._code, self._locals)  # pylint:disable=exec-used
+        except Exception as exception:
+            exception.snippet_code = self._code
+            raise
+        # The code might have changed the buffer in Vim directly.
+        vim_helper.verify_shadowed_lines()
 
         rv = str(
             self._snip.rv if self._snip._rv_changed else self._locals["res"]
         )  # pylint:disable=protected-access
+        self._background_budget = self._declared_budget(self._snip)
 
         if ct != rv:
             self.overwrite(buf, rv)
+            self._inputs = None
             return False
+        self._inputs = self._current_inputs(path, ct)
         return True
+
+    def _update_hints(self):
+        # Run after the tabstops we read and before the ones we wrote the
+        # last time, they are likely the same this time.
+        return self._tabstops_read, self._tabstops_written
@@ -3,12 +3,25 @@
 
 """Implements `echo hi` shell code interpolation."""
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import platform
-from subprocess import Popen, PIPE
+import re
+import select
+import shlex
+import signal
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 import stat
+import sys
 import tempfile
+import threading
+import time
+from typing import Any, Deque, Dict, List
+import uuid
 
+from UltiSnips import vim_helper
 from UltiSnips.text_objects.base import NoneditableTextObject
 
 
@@ -22,28 +35,172 @@ def _chomp(string):
     return string
 
 
-def _run_shell_command(cmd, tmpdir):
-    """Write the code to a temporary file."""
+class _TmpDirError(Exception):
+
+    """Raised if a script can not be written to or run from a tmp
+    directory."""
+
+
+# Defaults of g:UltiSnipsShellTimeout and g:UltiSnipsShellMaxOutput.
+_TIMEOUT = 10
+_MAX_OUTPUT = 1024 * 1024
+
+_TIMED_OUT = "\n[stopped after %g seconds]"
+_TRUNCATED = "\n[output truncated to %i bytes]"
+
+
+class _Output:
+
+    """Collects the output of a command, but keeps only its first
+    'max_output' bytes."""
+
+    def __init__(self, max_output):
+        self._data = bytearray()
+        self._max_output = max_output
+        self.size = 0
+
+    def add(self, data):
+        """Adds 'data' to the output."""
+        self.size += len(data)
+        room = self._max_output - len(self._data)
+        if room > 0:
+            self._data += data[:room]
+
+    def read_from(self, fd, stop):
+        """Adds everything that is written to 'fd' until it is closed or the
+        event 'stop' is set. Pipes can not be waited for on Windows, there it
+        only returns once the pipe is closed."""
+        can_wait = platform.system() != "Windows"
+        while not stop.is_set():
+            if can_wait and not select.select([fd], [], [], 0.1)[0]:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                return
+            self.add(data)
+
+    def text(self, size=None):
+        """The first 'size' bytes of the output, all if None. A note is added
+        if some of them were dropped."""
+        if size is None:
+            size = self.size
+        text = _chomp(bytes(self._data[:size]).decode("utf-8", "replace"))
+        if size > self._max_output:
+            text += _TRUNCATED % self._max_output
+        return text
+
+
+_NEW_PROCESS_GROUP: Dict[str, Any]
+if sys.platform == "win32":
+    from subprocess import CREATE_NEW_PROCESS_GROUP
+
+    _NEW_PROCESS_GROUP = {"creationflags": CREATE_NEW_PROCESS_GROUP}
+else:
+    _NEW_PROCESS_GROUP = {"start_new_session": True}
+
+
+def _kill_process_group(proc):
+    """Kills 'proc' and everything it started, which was started with
+    _NEW_PROCESS_GROUP."""
+    try:
+        if platform.system() == "Windows":
+            Popen(
+                ["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+            ).wait()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+
+# How many commands shell_runs() remembers.
+_RUN_LOG_SIZE = 20
+
+_run_log: Deque[Dict[str, Any]] = deque(maxlen=_RUN_LOG_SIZE)
+
+
+def _log_run(cmd, seconds, status):
+    """Remembers that 'cmd' took 'seconds' and exited with 'status', which is
+    None if it was stopped."""
+    _run_log.append(
+        {
+            "command": cmd,
+            "seconds": round(seconds, 3),
+            "status": "timeout" if status is None else status,
+        }
+    )
+
+
+def shell_runs():
+    """The commands that ran last, oldest first. Each is a dictionary with
+    the 'command', the 'seconds' it took and its exit 'status'."""
+    return list(_run_log)
+
+
+def _run_shell_command(cmd, tmpdir, timeout, max_output, log=True):
+    """Write the code to a temporary file and run it. It is stopped after
+    'timeout' seconds and only 'max_output' bytes of its output are kept. If
+    'log' is True, the run is remembered for shell_runs()."""
+    script = cmd
     cmdsuf = ""
     if platform.system() == "Windows":
         # suffix required to run command on windows
         cmdsuf = ".bat"
         # turn echo off
-        cmd = "@echo off\r\n" + cmd
-    handle, path = tempfile.mkstemp(text=True, dir=tmpdir, suffix=cmdsuf)
-    os.write(handle, cmd.encode("utf-8"))
+        script = "@echo off\r\n" + cmd
+    try:
+        handle, path = tempfile.mkstemp(text=True, dir=tmpdir, suffix=cmdsuf)
+    except OSError as error:
+        raise _TmpDirError(error)
+    os.write(handle, script.encode("utf-8"))
     os.close(handle)
     os.chmod(path, stat.S_IRWXU)
 
-    # Execute the file and read stdout
-    proc = Popen(path, shell=True, stdout=PIPE, stderr=PIPE)
-    proc.wait()
-    stdout, _ = proc.communicate()
+    # Execute the file and read stdout while it runs, so that it never
+    # blocks on a full pipe.
+    start = time.monotonic()
+    proc = Popen(path, shell=True, stdout=PIPE, stderr=DEVNULL, **_NEW_PROCESS_GROUP)
+    output = _Output(max_output)
+    stop_reading = threading.Event()
+
+    def _read():
+        try:
+            output.read_from(proc.stdout.fileno(), stop_reading)
+        finally:
+            proc.stdout.close()
+
+    reader = threading.Thread(target=_read)
+    reader.daemon = True
+    reader.start()
+    try:
+        proc.wait(timeout)
+    except TimeoutExpired:
+        pass
+    # Processes started by the command may keep the pipe open.
+    reader.join(max(start + timeout - time.monotonic(), 0))
+    timed_out = proc.poll() is None or reader.is_alive()
+    if timed_out:
+        _kill_process_group(proc)
+        # Processes that left the process group may still hold the pipe.
+        stop_reading.set()
+        reader.join(1)
     os.unlink(path)
-    return _chomp(stdout.decode("utf-8"))
+    if log:
+        _log_run(cmd, time.monotonic() - start, None if timed_out else proc.returncode)
 
+    text = output.text()
+    if timed_out:
+        return text + _TIMED_OUT % timeout
+    if proc.returncode == 126:
+        # The shell could not execute the file.
+        raise _TmpDirError(text)
+    return text
 
-def _get_tmp():
+
+def _find_tmp():
     """Find an executable tmp directory."""
     userdir = os.path.expanduser("~")
     for testdir in [
@@ -52,15 +209,265 @@ def _get_tmp():
         os.path.join(userdir, ".tmp"),
         userdir,
     ]:
-        if (
-            not os.path.exists(testdir)
-            or not _run_shell_command("echo success", testdir) == "success"
-        ):
+        if not os.path.exists(testdir):
+            continue
+        try:
+            output = _run_shell_command(
+                "echo success", testdir, _TIMEOUT, 64, log=False
+            )
+            if output == "success":
+                return testdir
+        except _TmpDirError:
             continue
-        return testdir
     return ""
 
 
+_tmpdir = None
+_tmpdir_lock = threading.Lock()
+
+
+def _get_tmp():
+    """The executable tmp directory, or "" if there is none. It is looked for
+    when the first command needs it, and again only if it was not found."""
+    global _tmpdir
+    with _tmpdir_lock:
+        if _tmpdir is None:
+            _tmpdir = _find_tmp() or None
+        return _tmpdir or ""
+
+
+def _forget_tmp(tmpdir):
+    """Makes _get_tmp() look again, because running a script from 'tmpdir'
+    failed."""
+    global _tmpdir
+    with _tmpdir_lock:
+        if _tmpdir == tmpdir:
+            _tmpdir = None
+
+
+def _run_in_tmp(cmd, timeout, max_output):
+    """Runs 'cmd' from the executable tmp directory. If that fails, the
+    directory is looked for again and 'cmd' is run from the new one."""
+    tmpdir = _get_tmp()
+    if not tmpdir:
+        return "Unable to find executable tmp directory, check noexec on /tmp"
+    try:
+        return _run_shell_command(cmd, tmpdir, timeout, max_output)
+    except _TmpDirError as error:
+        _forget_tmp(tmpdir)
+        new_tmpdir = _get_tmp()
+        if new_tmpdir == tmpdir:
+            # The command itself failed.
+            return str(error)
+        return _run_in_tmp(cmd, timeout, max_output)
+
+
+class _WorkerError(Exception):
+
+    """Raised if a _ShellWorker died."""
+
+
+class _ShellWorker:
+
+    """A shell that keeps running and runs one command after the other.
+
+    Each command runs in a subshell of its own, so that it can not change the
+    working directory or the environment of the ones after it. This saves
+    writing a script and starting a new shell for every command.
+
+    """
+
+    def __init__(self):
+        self._marker = "UltiSnips-done-%s" % uuid.uuid4().hex
+        self._end = re.compile(
+            ("\n%s (\\d+)\n\\Z" % self._marker).encode("ascii")
+        )
+        self._environ = dict(os.environ)
+        self._proc = Popen(
+            ["/bin/sh"],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+            **_NEW_PROCESS_GROUP
+        )
+
+    def is_usable(self):
+        """True if the shell still runs with the environment of Vim."""
+        return self._proc.poll() is None and self._environ == dict(os.environ)
+
+    def kill(self):
+        """Stops the shell and the command it runs."""
+        _kill_process_group(self._proc)
+
+    def run(self, cmd, timeout, max_output):
+        """Returns the output of 'cmd', see _run_shell_command(). If it takes
+        longer than 'timeout' seconds, the shell is killed."""
+        script = "( cd %s && eval %s ) </dev/null\nprintf '\\n%s %%d\\n' $?\n" % (
+            shlex.quote(os.getcwd()),
+            shlex.quote(cmd),
+            self._marker,
+        )
+        try:
+            self._proc.stdin.write(script.encode("utf-8"))
+            self._proc.stdin.flush()
+        except OSError:
+            raise _WorkerError()
+
+        start = time.monotonic()
+        fd = self._proc.stdout.fileno()
+        output = _Output(max_output)
+        # Enough of the end of the output to find the marker in.
+        tail = b""
+        while True:
+            match = self._end.search(tail)
+            if match:
+                break
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.kill()
+                _log_run(cmd, time.monotonic() - start, None)
+                return output.text() + _TIMED_OUT % timeout
+            data = os.read(fd, 65536)
+            if not data:
+                raise _WorkerError()
+            output.add(data)
+            tail = (tail + data)[-len(self._marker) - 32 :]
+        _log_run(cmd, time.monotonic() - start, int(match.group(1)))
+        return output.text(output.size - len(match.group(0)))
+
+
+_idle_workers: List[_ShellWorker] = []
+_idle_workers_lock = threading.Lock()
+
+
+def _can_run_in_worker(cmd):
+    """True if 'cmd' can run in a _ShellWorker. Scripts with a #! line need
+    their own interpreter."""
+    return platform.system() != "Windows" and not cmd.startswith("#!")
+
+
+def _run_in_worker(cmd, timeout, max_output):
+    """Like _run_in_tmp(), but runs 'cmd' in an idle _ShellWorker. A new
+    worker is started if there is none, or if the old one died."""
+    with _idle_workers_lock:
+        worker = _idle_workers.pop() if _idle_workers else None
+    if worker is None or not worker.is_usable():
+        if worker is not None:
+            worker.kill()
+        worker = _ShellWorker()
+    try:
+        output = worker.run(cmd, timeout, max_output)
+    except _WorkerError:
+        worker.kill()
+        return _run_in_tmp(cmd, timeout, max_output)
+    if worker.is_usable():
+        with _idle_workers_lock:
+            _idle_workers.append(worker)
+    return output
+
+
+class _OutputCache:
+
+    """Remembers the output of shell commands. Only the most recently used
+    ones are kept."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, ttl):
+        """The output for 'key' if it is younger than 'ttl' seconds, else
+        None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, output, size):
+        """Remembers 'output' for 'key' and keeps at most 'size' entries."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), output)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hits, misses and number of entries."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+_cache = _OutputCache()
+
+
+def cache_stats():
+    """How the cache of shell output did so far, see _OutputCache.stats()."""
+    return _cache.stats()
+
+
+def _run_cached(run, cmd, cwd, ttl, size):
+    """Returns the output of 'cmd' from the cache if it ran in 'cwd' less
+    than 'ttl' seconds ago, otherwise calls 'run' for it."""
+    key = (cmd, cwd)
+    output = _cache.get(key, ttl)
+    if output is None:
+        output = run(cmd)
+        _cache.put(key, output, size)
+    return output
+
+
+# How many shell interpolations run at the same time.
+_MAX_RUNNING = 4
+
+_executor = None
+
+
+def _get_executor():
+    """The threads that run the shell interpolations."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_MAX_RUNNING)
+    return _executor
+
+
+def find_tmp_in_background():
+    """Starts to look for the executable tmp directory, so that the first
+    shell interpolation does not have to wait for it."""
+    _get_executor().submit(_get_tmp)
+
+
+def _start(cmd):
+    """Starts to run 'cmd' in a thread. Returns a future for its output."""
+    ttl, size, use_worker, timeout, max_output = vim_helper.eval(
+        "[get(g:, 'UltiSnipsShellCacheTTL', 0), "
+        "get(g:, 'UltiSnipsShellCacheSize', 100), "
+        "get(g:, 'UltiSnipsShellWorker', 0), "
+        "get(g:, 'UltiSnipsShellTimeout', %i), "
+        "get(g:, 'UltiSnipsShellMaxOutput', %i)]" % (_TIMEOUT, _MAX_OUTPUT)
+    )
+    run = _run_in_tmp
+    if use_worker == "1" and _can_run_in_worker(cmd):
+        run = _run_in_worker
+    run = functools.partial(
+        run, timeout=float(timeout), max_output=int(max_output)
+    )
+    if float(ttl) > 0:
+        return _get_executor().submit(
+            _run_cached, run, cmd, os.getcwd(), float(ttl), int(size)
+        )
+    return _get_executor().submit(run, cmd)
+
+
 class ShellCode(NoneditableTextObject):
 
     """See module docstring."""
@@ -68,13 +475,12 @@ class ShellCode(NoneditableTextObject):
     def __init__(self, parent, token):
         NoneditableTextObject.__init__(self, parent, token)
         self._code = token.code.replace("\\`", "`")
-        self._tmpdir = _get_tmp()
+        # All shell code of a snippet runs at the same time while the
+        # snippet is set up, each _update() only waits for its output.
+        self._output = _start(self._code)
 
     def _update(self, done, buf):
-        if not self._tmpdir:
-            output = "Unable to find executable tmp directory, check noexec on /tmp"
-        else:
-            output = _run_shell_command(self._code, self._tmpdir)
+        output = self._output.result()
         self.overwrite(buf, output)
         self._parent._del_child(self)  # pylint:disable=protected-access
         return True
@@ -9,10 +9,102 @@ also a TextObject.
 
 """
 
+from collections import defaultdict
+import heapq
+
 from UltiSnips import vim_helper
 from UltiSnips.position import Position, JumpDirection
 from UltiSnips.text_objects.base import EditableTextObject, NoneditableTextObject
+from UltiSnips.text_objects.choices import Choices
 from UltiSnips.text_objects.tabstop import TabStop
+from UltiSnips.text_objects.viml_code import (
+    VimLCode,
+    evaluate_together,
+    forget_values,
+)
+from UltiSnips.vim_state import snapshot_for_update
+
+
+_DID_NOT_CONVERGE = (
+    "The snippets content did not converge: Check for Cyclic "
+    "dependencies or random strings in your snippet. You can use "
+    "'if not snip.c' to make sure to only expand random output "
+    "once."
+)
+
+
+def _topological_order(objects, with_hints):
+    """Returns 'objects' sorted so that each comes after its update
+    dependencies (and hints if 'with_hints') or None if there is a cycle.
+    Otherwise independent objects keep their order of position."""
+    # pylint:disable=protected-access
+    rank = {obj: idx for idx, obj in enumerate(sorted(objects))}
+    waiting_for = dict.fromkeys(rank, 0)
+    unblocks = defaultdict(list)
+
+    def _add_edge(first, second):
+        """'second' must be updated after 'first'."""
+        if first in rank and second in rank and first is not second:
+            unblocks[first].append(second)
+            waiting_for[second] += 1
+
+    for obj in rank:
+        for dependency in obj._update_dependencies():
+            _add_edge(dependency, obj)
+        if with_hints:
+            before, after = obj._update_hints()
+            for other in before:
+                _add_edge(other, obj)
+            for other in after:
+                _add_edge(obj, other)
+
+    ready = [(rank[obj], obj) for obj, count in waiting_for.items() if not count]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, obj = heapq.heappop(ready)
+        order.append(obj)
+        for other in unblocks[obj]:
+            waiting_for[other] -= 1
+            if not waiting_for[other]:
+                heapq.heappush(ready, (rank[other], other))
+    if len(order) != len(rank):
+        return None
+    return order
+
+
+def _update_order(objects):
+    """Returns the order in which 'objects' must be updated. Raises if their
+    dependencies are cyclic."""
+    order = _topological_order(objects, with_hints=True)
+    if order is None:
+        order = _topological_order(objects, with_hints=False)
+    if order is None:
+        raise RuntimeError(_DID_NOT_CONVERGE)
+    return order
+
+
+def _end_of_viml_run(order, start):
+    """Returns the index after the VimL code in 'order' from 'start' on that
+    can be evaluated at once, because nothing that runs code or changes the
+    buffer is updated in between. The run also ends before VimL code on a line
+    that earlier VimL code of the run writes to, as that code would see the
+    line without the text of the earlier one."""
+    written = set()
+    end = start
+    while end < len(order):
+        obj = order[end]
+        if isinstance(obj, VimLCode):
+            if obj.start.line in written:
+                break
+            written.update(range(obj.start.line, obj.end.line + 1))
+        elif type(obj)._update not in (
+            EditableTextObject._update,
+            NoneditableTextObject._update,
+        ):
+            break
+        end += 1
+    return end
 
 
 class SnippetInstance(EditableTextObject):
@@ -45,6 +137,11 @@ class SnippetInstance(EditableTextObject):
         self.globals = globals
         self.visual_content = visual_content
         self.current_placeholder = None
+        self._marks = None
+        self._marked = []
+        self._mark_index = {}
+        self._marks_valid = False
+        self._marks_tick = None
 
         EditableTextObject.__init__(self, parent, start, end, initial_text)
 
@@ -63,9 +160,111 @@ class SnippetInstance(EditableTextObject):
     def replay_user_edits(self, cmds, ctab=None):
         """Replay the edits the user has done to keep endings of our Text
         objects in sync with reality."""
+        if self._follow_marks(cmds, ctab):
+            return
         for cmd in cmds:
             self._do_edit(cmd, ctab)
 
+    def track_positions_with(self, marks):
+        """Lets 'marks' (see UltiSnips.position_marks) follow the positions of
+        our text objects, so that simple edits do not need to be replayed."""
+        self._marks = marks
+        self._marks_valid = False
+
+    def check_position_marks(self):
+        """Forgets the marks if the buffer was changed since they were last
+        in sync, e.g. by an action. Marks only follow the edits of the user
+        reliably, our own writes replace whole lines."""
+        if self._marks_valid and vim_helper.eval("b:changedtick") != self._marks_tick:
+            self._marks_valid = False
+
+    def stop_tracking_positions(self):
+        """Removes the marks that follow our positions."""
+        if self._marks is not None:
+            self._marks.clear()
+        self._marks = None
+        self._marked = []
+        self._mark_index = {}
+        self._marks_valid = False
+
+    def _follow_marks(self, cmds, ctab):
+        """Takes all positions from the marks instead of replaying 'cmds'.
+
+        This is only done for one insertion or deletion inside a plain tabstop
+        without children, where moving the marks like Vim did gives the same
+        result as replaying. To be sure that Vim saw the same edit, the new
+        ends of 'ctab' and of us are checked against the replay. Returns False
+        if the edits need to be replayed.
+
+        """
+        if self._marks is None or not self._marks_valid or len(cmds) != 1:
+            return False
+        if not isinstance(ctab, TabStop) or isinstance(ctab, Choices):
+            return False
+        if ctab._parent is None or ctab._children:
+            return False
+        ctype, line, col, text = cmds[0]
+        pivot = Position(line, col)
+        delta = Position(1, 0) if text == "\n" else Position(0, len(text))
+        if ctype == "I":
+            if not ctab._start < pivot <= ctab._end:
+                return False
+        else:
+            delend = pivot + delta if text != "\n" else Position(line + 1, 0)
+            if not ctab._start <= pivot < ctab._end or ctab._end < delend:
+                return False
+            delta.line *= -1
+            delta.col *= -1
+
+        positions = self._marks.read()
+        if positions is None:
+            return False
+        expected = {}
+        for pos in (ctab._start, ctab._end, self._end):
+            moved = Position(pos.line, pos.col)
+            if pos is not ctab._start:
+                moved.move(pivot, delta)
+            expected[self._mark_index[id(pos)]] = moved
+        if any(Position(*positions[idx]) != pos for idx, pos in expected.items()):
+            return False
+
+        for pos, (line, col) in zip(self._marked, positions):
+            pos.line, pos.col = line, col
+        self._marks_tick = vim_helper.eval("b:changedtick")
+        return True
+
+    def _place_marks(self):
+        """Puts a mark on each position of our text objects."""
+        vim_helper.flush_deferred_writes()
+        positions = []
+
+        def _collect(obj):
+            """Collects the positions of 'obj' and its children."""
+            positions.append(obj._start)
+            positions.append(obj._end)
+            if isinstance(obj, EditableTextObject):
+                for child in obj._children:
+                    _collect(child)
+
+        _collect(self)
+        self._marked = positions
+        self._mark_index = {id(pos): idx for idx, pos in enumerate(positions)}
+        self._marks.place(positions)
+        self._marks_valid = True
+        self._marks_tick = vim_helper.eval("b:changedtick")
+
+    def _move(self, pivot, diff):
+        self._marks_valid = False
+        EditableTextObject._move(self, pivot, diff)
+
+    def _child_has_moved(self, idx, pivot, diff):
+        self._marks_valid = False
+        EditableTextObject._child_has_moved(self, idx, pivot, diff)
+
+    def _child_was_added(self):
+        self._marks_valid = False
+        EditableTextObject._child_was_added(self)
+
     def update_textobjects(self, buf):
         """Update the text objects that should change automagically after the
         users edits have been replayed.
@@ -73,7 +272,10 @@ class SnippetInstance(EditableTextObject):
         This might also move the Cursor
 
         """
+        marks_valid = self._marks_valid
         vc = _VimCursor(self)
+        # Cleared again if an update moves any of our text objects.
+        self._marks_valid = True
         done = set()
         not_done = set()
 
@@ -85,23 +287,41 @@ class SnippetInstance(EditableTextObject):
             not_done.add(obj)
 
         _find_recursive(self)
-
-        counter = 10
-        while (done != not_done) and counter:
-            # Order matters for python locals!
-            for obj in sorted(not_done - done):
-                if obj._update(done, buf):
+        viml_codes = [obj for obj in not_done if isinstance(obj, VimLCode)]
+
+        with snapshot_for_update():
+            # Order matters for python locals! Objects that do not depend on
+            # each other are therefore updated in the order of their position.
+            order = _update_order(not_done)
+            evaluated_until = 0
+            try:
+                for idx, obj in enumerate(order):
+                    if isinstance(obj, VimLCode) and idx >= evaluated_until:
+                        evaluated_until = _end_of_viml_run(order, idx)
+                        evaluate_together(
+                            [
+                                code
+                                for code in order[idx:evaluated_until]
+                                if isinstance(code, VimLCode)
+                            ]
+                        )
+                    counter = 10
+                    while not obj._update(done, buf):
+                        counter -= 1
+                        if not counter:
+                            raise RuntimeError(_DID_NOT_CONVERGE)
                     done.add(obj)
-            counter -= 1
-        if not counter:
-            raise RuntimeError(
-                "The snippets content did not converge: Check for Cyclic "
-                "dependencies or random strings in your snippet. You can use "
-                "'if not snip.c' to make sure to only expand random output "
-                "once."
-            )
+            finally:
+                forget_values(viml_codes)
         vc.to_vim()
         self._del_child(vc)
+        moved = not self._marks_valid
+        self._marks_valid = marks_valid and not moved
+        # Placing the marks costs about as much as replaying one edit. It
+        # only pays off if the updates do not move things on every keystroke,
+        # e.g. with mirrors of the tabstop that is typed in.
+        if self._marks is not None and not self._marks_valid and not moved:
+            self._place_marks()
 
     def select_next_tab(self, jump_direction: JumpDirection):
         """Selects the next tabstop in the direction of 'jump_direction'."""
@@ -3,80 +3,181 @@
 
 """Implements TabStop transformations."""
 
+import functools
 import re
 import sys
 
-from UltiSnips.text import unescape, fill_in_whitespace
 from UltiSnips.text_objects.mirror import Mirror
 
 
-def _find_closing_brace(string, start_pos):
-    """Finds the corresponding closing brace after start_pos."""
-    bracks_open = 1
-    escaped = False
-    for idx, char in enumerate(string[start_pos:]):
-        if char == "(":
-            if not escaped:
-                bracks_open += 1
-        elif char == ")":
-            if not escaped:
-                bracks_open -= 1
-            if not bracks_open:
-                return start_pos + idx + 1
-        if char == "\\":
-            escaped = not escaped
-        else:
-            escaped = False
-
-
-def _split_conditional(string):
-    """Split the given conditional 'string' into its arguments."""
-    bracks_open = 0
-    args = []
-    carg = ""
-    escaped = False
-    for idx, char in enumerate(string):
-        if char == "(":
-            if not escaped:
-                bracks_open += 1
-        elif char == ")":
-            if not escaped:
-                bracks_open -= 1
-        elif char == ":" and not bracks_open and not escaped:
-            args.append(carg)
-            carg = ""
-            escaped = False
+_GROUP_REFERENCE = re.compile(r"\$(\d+)")
+_CONDITIONAL = re.compile(r"\(\?(\d+):")
+_ESCAPED_WHITESPACE = {"n": "\n", "t": "\t", "r": "\r", "a": "\a", "b": "\b"}
+
+# Kinds of instructions in a compiled replacement, see _ReplacementCompiler.
+_TEXT, _GROUP, _CASE_NEXT, _CASE_FOLD, _CONDITION = range(5)
+
+
+class _ReplacementCompiler:
+
+    """Turns a replacement into a list of instructions, each a tuple:
+
+    (_TEXT, text): literal text.
+    (_GROUP, number): the text of capture group 'number'.
+    (_CASE_NEXT, case): 'u' or 'l', changes the case of the next character.
+    (_CASE_FOLD, case, instructions): 'U' or 'L', changes the case of all
+        text of 'instructions'.
+    (_CONDITION, number, if_set, if_not_set): the instructions of 'if_set'
+        if capture group 'number' matched something, else those of
+        'if_not_set'.
+
+    """
+
+    def __init__(self, expression):
+        self._expression = expression
+
+    def compile(self):
+        """Returns the instructions for the whole replacement."""
+        return self._compile(0, "", "")[0]
+
+    def _compile(self, pos, stop, fold):
+        """Returns the instructions for the replacement from 'pos' on, the
+        position after them and True if they ended at '\\E'. Unescaped
+        characters in 'stop' end them, unless they are in parentheses; 'stop'
+        is only set for the branches of conditionals. '\\E' only ends them in
+        the 'fold' of a '\\U' or '\\L'."""
+        expression = self._expression
+        program = []
+        text = ""
+        depth = 0
+        while pos < len(expression):
+            char = expression[pos]
+            if char == "\\" and pos + 1 < len(expression):
+                escaped = expression[pos + 1]
+                pos += 2
+                if escaped == "E" and fold:
+                    _add_text(program, text)
+                    return program, pos, True
+                if escaped == "$" and _GROUP_REFERENCE.match(expression, pos - 1):
+                    # Groups are filled in even after a backslash.
+                    pos -= 1
+                    continue
+                if escaped in "ul" and pos < len(expression):
+                    # Switching the case of a backslash or a parenthesis
+                    # does nothing.
+                    if expression[pos] != "\\" and not self._conditional_at(pos):
+                        _add_text(program, text)
+                        text = ""
+                        program.append((_CASE_NEXT, escaped))
+                    elif expression[pos : pos + 2] in ("\\u", "\\l"):
+                        # ... and leaves a switch after it a plain letter.
+                        text += expression[pos + 1]
+                        pos += 2
+                    continue
+                if escaped in "UL" and not fold:
+                    folded, end, closed = self._compile(pos, stop, escaped)
+                    if closed:
+                        _add_text(program, text)
+                        text = ""
+                        program.append((_CASE_FOLD, escaped, folded))
+                        pos = end
+                        continue
+                if not stop:
+                    # The case is changed before whitespace is filled in,
+                    # but branches only have their escapes removed.
+                    case_changed = {"U": escaped.upper(), "L": escaped.lower()}
+                    escaped = _ESCAPED_WHITESPACE.get(
+                        case_changed.get(fold, escaped), escaped
+                    )
+                text += escaped
+                continue
+            match = _GROUP_REFERENCE.match(expression, pos)
+            if match:
+                _add_text(program, text)
+                text = ""
+                program.append((_GROUP, int(match.group(1))))
+                pos = match.end()
+                continue
+            conditional = self._conditional_at(pos)
+            if conditional:
+                _add_text(program, text)
+                text = ""
+                program.append(conditional[0])
+                pos = conditional[1]
+                continue
+            if stop:
+                if char == "(":
+                    depth += 1
+                elif char == ")" and depth:
+                    depth -= 1
+                elif char in stop and not depth:
+                    break
+            text += char
+            pos += 1
+        _add_text(program, text)
+        return program, pos, False
+
+    def _conditional_at(self, pos):
+        """Returns the instruction for the conditional at 'pos' and the
+        position after it, or None if there is none."""
+        match = _CONDITIONAL.match(self._expression, pos)
+        if match is None:
+            return None
+        # Only the first two branches are used.
+        branches = []
+        pos = match.end()
+        while pos < len(self._expression):
+            branch, pos, _ = self._compile(pos, ":)", "")
+            branches.append(branch)
+            if pos == len(self._expression):
+                break
+            pos += 1
+            if self._expression[pos - 1] == ")":
+                branches.append([])
+                return (
+                    (_CONDITION, int(match.group(1)), branches[0], branches[1]),
+                    pos,
+                )
+        return None
+
+
+def _add_text(program, text):
+    """Adds the instruction for the literal 'text' to 'program'."""
+    if text:
+        program.append((_TEXT, text))
+
+
+def _render(program, match, parts):
+    """Appends the text of 'program' for 'match' to 'parts'. Returns the one
+    character case switch that had no character left to change, e.g. because
+    the group after it was empty, or None."""
+    case = None
+    for instruction in program:
+        kind = instruction[0]
+        if kind == _CASE_NEXT:
+            case = instruction[1]
             continue
-        carg += char
-        if char == "\\":
-            escaped = not escaped
+        if kind == _CONDITION:
+            taken = instruction[2] if match.group(instruction[1]) else instruction[3]
+            case = None
+            _render(taken, match, parts)
+            continue
+        if kind == _TEXT:
+            text = instruction[1]
+        elif kind == _GROUP:
+            text = match.group(instruction[1]) or ""
         else:
-            escaped = False
-    args.append(carg)
-    return args
-
-
-def _replace_conditional(match, string):
-    """Replaces a conditional match in a transformation."""
-    conditional_match = _CONDITIONAL.search(string)
-    while conditional_match:
-        start = conditional_match.start()
-        end = _find_closing_brace(string, start + 4)
-        args = _split_conditional(string[start + 4 : end - 1])
-        rv = ""
-        if match.group(int(conditional_match.group(1))):
-            rv = unescape(_replace_conditional(match, args[0]))
-        elif len(args) > 1:
-            rv = unescape(_replace_conditional(match, args[1]))
-        string = string[:start] + rv + string[end:]
-        conditional_match = _CONDITIONAL.search(string)
-    return string
-
-
-_ONE_CHAR_CASE_SWITCH = re.compile(r"\\([ul].)", re.DOTALL)
-_LONG_CASEFOLDINGS = re.compile(r"\\([UL].*?)\\E", re.DOTALL)
-_DOLLAR = re.compile(r"\$(\d+)", re.DOTALL)
-_CONDITIONAL = re.compile(r"\(\?(\d+):", re.DOTALL)
+            fold = []
+            _render(instruction[2], match, fold)
+            text = "".join(fold)
+            text = text.upper() if instruction[1] == "U" else text.lower()
+            case = None
+        if case is not None and text:
+            first = text[0].upper() if case == "u" else text[0].lower()
+            text = first + text[1:]
+            case = None
+        parts.append(text)
+    return case
 
 
 class _CleverReplace:
@@ -84,36 +185,23 @@ class _CleverReplace:
     """Mimics TextMates replace syntax."""
 
     def __init__(self, expression):
-        self._expression = expression
+        self._program = _ReplacementCompiler(expression).compile()
 
     def replace(self, match):
         """Replaces 'match' through the correct replacement string."""
-        transformed = self._expression
-        # Replace all $? with capture groups
-        transformed = _DOLLAR.subn(lambda m: match.group(int(m.group(1))), transformed)[
-            0
-        ]
-
-        # Replace Case switches
-        def _one_char_case_change(match):
-            """Replaces one character case changes."""
-            if match.group(1)[0] == "u":
-                return match.group(1)[-1].upper()
-            else:
-                return match.group(1)[-1].lower()
-
-        transformed = _ONE_CHAR_CASE_SWITCH.subn(_one_char_case_change, transformed)[0]
-
-        def _multi_char_case_change(match):
-            """Replaces multi character case changes."""
-            if match.group(1)[0] == "U":
-                return match.group(1)[1:].upper()
-            else:
-                return match.group(1)[1:].lower()
-
-        transformed = _LONG_CASEFOLDINGS.subn(_multi_char_case_change, transformed)[0]
-        transformed = _replace_conditional(match, transformed)
-        return unescape(fill_in_whitespace(transformed))
+        parts = []
+        case = _render(self._program, match, parts)
+        if case is not None:
+            # A switch at the very end is just an escaped letter.
+            parts.append(case)
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=256)
+def _clever_replace(expression):
+    """The _CleverReplace for 'expression', shared by all transformations
+    that use it."""
+    return _CleverReplace(expression)
 
 
 # flag used to display only one time the lack of unidecode
@@ -144,7 +232,7 @@ class TextObjectTransformation:
                 self._convert_to_ascii = True
 
         self._find = re.compile(token.search, flags | re.DOTALL)
-        self._replace = _CleverReplace(token.replace)
+        self._replace = _clever_replace(token.replace)
 
     def _transform(self, text):
         """Do the actual transform on the given text."""
@@ -7,15 +7,46 @@ from UltiSnips import vim_helper
 from UltiSnips.text_objects.base import NoneditableTextObject
 
 
+def evaluate_together(objects):
+    """Evaluates the code of the VimLCode 'objects' in one call to Vim, in
+    their order. Each uses its result in its next _update(), so nothing else
+    may run before they are updated in the same order. Evaluation stops at the
+    first one that fails; it and the ones after it evaluate on their own, so
+    that the error comes from the right one and nothing runs twice."""
+    if len(objects) < 2:
+        return
+    vim_helper.flush_deferred_writes()  # VimL only sees the buffer in Vim.
+    values = vim_helper.eval(
+        "UltiSnips#EvaluateInOrder([%s])"
+        % ", ".join("'%s'" % obj._code.replace("'", "''") for obj in objects)
+    )
+    vim_helper.verify_shadowed_lines()
+    for obj, value in zip(objects, values):
+        obj._value = value  # pylint:disable=protected-access
+
+
+def forget_values(objects):
+    """Drops the results that evaluate_together() left for the VimLCode
+    'objects', e.g. because their update was cut short by an error."""
+    for obj in objects:
+        obj._value = None  # pylint:disable=protected-access
+
+
 class VimLCode(NoneditableTextObject):
 
     """See module docstring."""
 
     def __init__(self, parent, token):
         self._code = token.code.replace("\\`", "`").strip()
+        self._value = None
 
         NoneditableTextObject.__init__(self, parent, token)
 
     def _update(self, done, buf):
-        self.overwrite(buf, vim_helper.eval(self._code))
+        value, self._value = self._value, None
+        if value is None:
+            vim_helper.flush_deferred_writes()  # VimL only sees the buffer in Vim.
+            value = vim_helper.eval(self._code)
+            vim_helper.verify_shadowed_lines()
+        self.overwrite(buf, value)
         return True
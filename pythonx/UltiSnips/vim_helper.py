@@ -61,6 +61,184 @@ class VimBuffer:
         vim.current.window.cursor = pos.line + 1, nbyte
 
 
+class ShadowVimBuffer(VimBuffer):
+
+    """Keeps a copy of the lines 'first' to 'last' of a buffer in memory.
+
+    While a snippet updates, its text objects read their text many times.
+    These reads are served from the copy instead of asking Vim every time.
+    Changes are applied to the copy and written to the wrapped buffer right
+    away. Changes outside of the lines in memory end the shadowing, and so
+    does code that changes the buffer in Vim behind our back, see verify().
+
+    """
+
+    def __init__(self, buffer, first, last):
+        self._buffer = buffer
+        self._first = first
+        self._count = last + 1 - first  # Lines in the wrapped buffer.
+        self._lines = list(buffer[first : last + 1])
+        self._length = len(buffer)  # Length of the wrapped buffer.
+
+    def flush(self):
+        """Writes pending changes to the wrapped buffer. There are none, all
+        changes are written right away."""
+
+    def verify(self):
+        """Writes pending changes and stops shadowing if the wrapped buffer
+        no longer holds the lines in memory. Called after snippet code ran
+        that might have changed the buffer in Vim directly, e.g. through
+        vim.current.buffer or vim.command()."""
+        self.flush()
+        if not self._lines:
+            return
+        if (
+            len(self._buffer) != self._length
+            or self._buffer[self._first : self._first + self._count] != self._lines
+        ):
+            self._stop_shadowing()
+
+    def _stop_shadowing(self):
+        """Serves all reads from the wrapped buffer from now on."""
+        self._first, self._count, self._lines = len(self._buffer), 0, []
+
+    def _lines_changed(self, start, stop, lines):
+        """Called after the lines 'start' to 'stop' (exclusive) in memory were
+        replaced by 'lines'."""
+        self._buffer[start:stop] = lines
+        self._length += len(self._lines) - self._count
+        self._count = len(self._lines)
+
+    def _to_buffer_index(self, idx):
+        """Returns the index of line 'idx' in the wrapped buffer or None if
+        the line is kept in memory."""
+        if idx < self._first:
+            return idx
+        if idx < self._first + len(self._lines):
+            return None
+        return idx - len(self._lines) + self._count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, _ = idx.indices(len(self))
+            if self._first <= start <= stop <= self._first + len(self._lines):
+                return self._lines[start - self._first : stop - self._first]
+            return [self[line] for line in range(start, max(start, stop))]
+        if idx < 0:
+            idx += len(self)
+        buffer_idx = self._to_buffer_index(idx)
+        if buffer_idx is None:
+            return self._lines[idx - self._first]
+        return self._buffer[buffer_idx]
+
+    def __setitem__(self, idx, text):
+        if isinstance(idx, slice):
+            start, stop, _ = idx.indices(len(self))
+            stop = max(start, stop)
+            lines = list(text)
+        else:
+            start = idx + len(self) if idx < 0 else idx
+            stop = start + 1
+            lines = [text]
+        if not self._first <= start <= stop <= self._first + len(self._lines):
+            # Not the text of our snippet, stop shadowing.
+            self.flush()
+            self._buffer[idx] = text
+            self._stop_shadowing()
+            return
+        self._lines[start - self._first : stop - self._first] = lines
+        self._lines_changed(start, stop, lines)
+
+    def __len__(self):
+        return len(self._buffer) - self._count + len(self._lines)
+
+    @property
+    def line_till_cursor(self):
+        """Returns the text before the cursor."""
+        cursor = self.cursor
+        return self[cursor.line][: cursor.col]
+
+    @property
+    def cursor(self):
+        """The current windows cursor, see VimBuffer."""
+        line, nbyte = vim.current.window.cursor
+        line -= 1
+        # Where Vim's cursor will be once all changes are written.
+        if line >= self._first + self._count:
+            line += len(self._lines) - self._count
+        elif line >= self._first:
+            line = min(line, self._first + len(self._lines) - 1)
+        encoding = vim.eval("&encoding")
+        text = self[line].encode(encoding, "replace")[:nbyte]
+        return Position(line, len(text.decode(encoding, "replace")))
+
+    @cursor.setter
+    def cursor(self, pos):
+        """See getter."""
+        self._buffer.cursor = pos
+
+
+class DeferredVimBuffer(ShadowVimBuffer):
+
+    """Like ShadowVimBuffer, but collects the changes in memory until
+    flush() is called.
+
+    Used while a snippet puts its initial text into Vim: every text object
+    writes its own text, so a snippet with many placeholders would otherwise
+    change the buffer in Vim many times before the user sees it.
+
+    """
+
+    def __init__(self, buffer, first, last):
+        ShadowVimBuffer.__init__(self, buffer, first, last)
+        self._cursor = None
+        self._changed = False
+
+    def flush(self):
+        """Writes the changed lines and the cursor to the wrapped buffer."""
+        if self._changed:
+            first, old_last, new_last = self._first, self._count, len(self._lines)
+            old_lines = self._buffer[first : first + old_last]
+            start = 0
+            while (
+                start < min(old_last, new_last)
+                and old_lines[start] == self._lines[start]
+            ):
+                start += 1
+            while (
+                old_last > start
+                and new_last > start
+                and old_lines[old_last - 1] == self._lines[new_last - 1]
+            ):
+                old_last -= 1
+                new_last -= 1
+            if start < old_last or start < new_last:
+                self._buffer[first + start : first + old_last] = self._lines[
+                    start:new_last
+                ]
+            self._length += len(self._lines) - self._count
+            self._count = len(self._lines)
+            self._changed = False
+        if self._cursor is not None:
+            self._buffer.cursor = self._cursor
+            self._cursor = None
+
+    def _lines_changed(self, start, stop, lines):
+        self._changed = True
+
+    @property
+    def cursor(self):
+        """The cursor as it will be after the lines are written."""
+        if self._cursor is not None:
+            return self._cursor
+        return ShadowVimBuffer.cursor.fget(self)
+
+    @cursor.setter
+    def cursor(self, pos):
+        """The cursor is set when the lines are written."""
+        self._cursor = pos
+
+
 buf = VimBuffer()  # pylint:disable=invalid-name
 
 
@@ -74,6 +252,48 @@ def option_set_to(name, new_value):
         command("set {0}={1}".format(name, old_value))
 
 
+@contextmanager
+def shadow_buffer(first, last):
+    """Serves reads of the lines 'first' to 'last' of the buffer from memory,
+    see ShadowVimBuffer."""
+    global buf  # pylint:disable=global-statement,invalid-name
+    old_buffer = buf
+    try:
+        buf = ShadowVimBuffer(buf, first, last)
+        yield
+    finally:
+        buf = old_buffer
+
+
+@contextmanager
+def defer_buffer_writes(first, last):
+    """Collects the changes to the lines 'first' to 'last' of the buffer in
+    memory and writes them to Vim at once in the end."""
+    global buf  # pylint:disable=global-statement,invalid-name
+    deferred_buffer = DeferredVimBuffer(buf, first, last)
+    old_buffer = buf
+    try:
+        buf = deferred_buffer
+        yield
+    finally:
+        buf = old_buffer
+        deferred_buffer.flush()
+
+
+def flush_deferred_writes():
+    """Writes the changes collected by defer_buffer_writes() to Vim now, e.g.
+    because code that looks at the buffer in Vim is about to run."""
+    if isinstance(buf, DeferredVimBuffer):
+        buf.flush()
+
+
+def verify_shadowed_lines():
+    """Called after code ran that might have changed the buffer in Vim
+    directly, see ShadowVimBuffer.verify()."""
+    if isinstance(buf, ShadowVimBuffer):
+        buf.verify()
+
+
 @contextmanager
 def save_mark(name):
     old_pos = get_mark_pos(name)
@@ -251,6 +471,32 @@ def get_cursor_pos():
     return _get_pos(".")
 
 
+def mark_cursor(name):
+    """Puts the mark 'name' on the cursor and returns the old position of the
+    mark, with a single call to Vim."""
+    mark = '"\'{0}"'.format(name)
+    return eval("[getpos({0}), setpos({0}, getpos(\".\"))]".format(mark))[0]
+
+
+def restore_mark(name, old_pos, move_cursor=False):
+    """Puts the mark 'name' back to 'old_pos' (or deletes it if that is zero)
+    and returns the position the mark had before. If 'move_cursor', the cursor
+    is first moved to the mark, unless the mark is gone. This is a single call
+    to Vim, only deleting the mark takes another."""
+    mark = '"\'{0}"'.format(name)
+    exprs = ["getpos({0})".format(mark)]
+    if move_cursor:
+        exprs.append(
+            'getpos({0})[1] ? setpos(".", getpos({0})) : -1'.format(mark)
+        )
+    if not _is_pos_zero(old_pos):
+        exprs.append("setpos({0}, {1})".format(mark, old_pos))
+    pos = eval("[" + ", ".join(exprs) + "]")[0]
+    if _is_pos_zero(old_pos):
+        delete_mark(name)
+    return pos
+
+
 def delete_mark(name):
     try:
         return command("delma " + name)
@@ -4,9 +4,13 @@
 """Some classes to conserve Vim's state for comparing over time."""
 
 from collections import deque, namedtuple
+from contextlib import contextmanager
 
 from UltiSnips import vim_helper
 from UltiSnips.compatibility import byte2col
+from UltiSnips.diff import edits_from_changed_lines
+from UltiSnips.edit_source import create_edit_source
+from UltiSnips.indent_util import indent_settings
 from UltiSnips.position import Position
 
 _Placeholder = namedtuple("_FrozenPlaceholder", ["current_text", "start", "end"])
@@ -36,6 +40,9 @@ class VimState:
     def __init__(self):
         self._poss = deque(maxlen=5)
         self._lvb = None
+        self._lvb_start = 0
+        self._lvb_tick = None
+        self._edit_source = None
 
         self._text_to_expect = ""
         self._unnamed_reg_cached = False
@@ -75,12 +82,59 @@ class VimState:
         """Remember the current position as a previous pose."""
         self._poss.append(VimPosition())
 
+    def listen_for_edits(self):
+        """Starts receiving the changes to the current buffer from Vim, if it
+        supports reporting them."""
+        if self._edit_source is None:
+            self._edit_source = create_edit_source()
+        if self._edit_source is not None:
+            self._edit_source.attach()
+
+    def stop_listening_for_edits(self):
+        """Reverse listen_for_edits."""
+        if self._edit_source is not None:
+            self._edit_source.detach()
+
+    def reported_edits(self):
+        """Returns the edit commands for the changes Vim reported since the
+        buffer was last remembered.
+
+        Returns None if Vim does not report changes or if they are not
+        contained in the remembered buffer. The edits must then be guessed.
+
+        """
+        if self._edit_source is None or self._lvb is None:
+            return None
+        change = self._edit_source.flush()
+        if change is None:
+            return ()
+        first, last_before, last_after = change
+        if first < self._lvb_start or last_before > self._lvb_start + len(self._lvb):
+            return None
+        return edits_from_changed_lines(
+            first,
+            self._lvb[first - self._lvb_start : last_before - self._lvb_start],
+            vim_helper.buf[first:last_after],
+            vim_helper.buf.cursor,
+        )
+
     def remember_buffer(self, to):
         """Remember the content of the buffer and the position."""
+        if self._edit_source is not None:
+            # These changes are already part of what we remember.
+            self._edit_source.flush()
+        to.check_position_marks()
         self._lvb = vim_helper.buf[to.start.line : to.end.line + 1]
+        self._lvb_start = to.start.line
         self._lvb_len = len(vim_helper.buf)
+        self._lvb_tick = vim_helper.eval("b:changedtick")
         self.remember_position()
 
+    @property
+    def buffer_changed(self):
+        """True if the buffer might have changed since it was remembered."""
+        return self._lvb_tick != vim_helper.eval("b:changedtick")
+
     @property
     def diff_in_buffer_length(self):
         """Returns the difference in the length of the current buffer compared
@@ -99,8 +153,69 @@ class VimState:
 
     @property
     def remembered_buffer(self):
-        """The content of the remembered buffer."""
-        return self._lvb[:]
+        """The content of the remembered buffer. Must not be changed."""
+        return self._lvb
+
+
+class VimSnapshot:
+
+    """What python code reads from Vim while the text objects of a snippet
+    are updated. Each value is read the first time it is needed and then
+    kept until the update is done, so asking again does not call Vim."""
+
+    def __init__(self):
+        self._file = None
+        self._indent = None
+        self._options = {}
+
+    @property
+    def file(self):
+        """expand("%"), expand("%:t") and expand("%:t:r")."""
+        if self._file is None:
+            self._file = vim_helper.eval(
+                '[expand("%"), expand("%:t"), expand("%:t:r")]'
+            )
+        return self._file
+
+    @property
+    def indent(self):
+        """The indent settings, see indent_settings()."""
+        if self._indent is None:
+            self._indent = indent_settings()
+        return self._indent
+
+    def opt(self, option):
+        """A list with the value of 'option', empty if it does not exist."""
+        if option not in self._options:
+            try:
+                self._options[option] = vim_helper.eval(
+                    "exists('%s') ? [%s] : []" % (option, option)
+                )
+            except vim_helper.error:
+                self._options[option] = []
+        return self._options[option]
+
+
+_snapshot = None
+
+
+@contextmanager
+def snapshot_for_update():
+    """Makes vim_snapshot() return the same VimSnapshot until the update of
+    the text objects is done."""
+    global _snapshot
+    old_snapshot, _snapshot = _snapshot, VimSnapshot()
+    try:
+        yield
+    finally:
+        _snapshot = old_snapshot
+
+
+def vim_snapshot():
+    """The VimSnapshot of the running update, a new one outside of it."""
+    if _snapshot is None:
+        return VimSnapshot()
+    return _snapshot
 
 
 class VisualContentPreserver:
@@ -106,6 +106,12 @@ class DeleteCurrentTabStop3_JumpAround(_VimTest):
     wanted = "hello\nendworld"
 
 
+class SubstituteInSeveralTabStops_JumpAround(_VimTest):
+    snippets = ("test", "${1:foo} ${2:bar} ${3:foo}")
+    keys = "test" + EX + ESC + ":s/foo/baz/g\n" + "i" + JF + "x" + JF + "y"
+    wanted = "baz x y"
+
+
 # Test for Bug #774917
 
 
@@ -27,6 +27,80 @@ class TabStop_Shell_TextInNextLine(_VimTest):
     wanted = "hi hallo\nWeiterand more"
 
 
+class TabStop_Shell_Several(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "`sleep 0.1; echo one` `echo two`\n`echo three`")
+    keys = "test" + EX + "and more"
+    wanted = "one two\nthreeand more"
+
+
+class TabStop_Shell_SeveralRunAtOnce(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    files = {
+        "us/all.snippets": r"""
+        snippet test "" "__import__('time').time()" e
+        ${1:`sleep 0.5; echo a` `sleep 0.5; echo b` `sleep 0.5; echo c` `sleep 0.5; echo d`} `!p
+        import time
+        t[1]  # Runs again once the output of the commands is in.
+        took = time.time() - snip.context
+        snip.rv = "at once" if took < 1.5 else "one by one"`
+        endsnippet
+        """
+    }
+    keys = "test" + EX
+    wanted = "a b c d at once"
+
+
+class TabStop_Shell_CachedOutput(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "hi `echo hallo`")
+    keys = "test" + EX + "\ntest" + EX
+    wanted = "hi hallo\nhi hallo"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsShellCacheTTL = 60")
+
+
+class TabStop_Shell_InWorker(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "`cd /; pwd` `pwd | grep -c '^/$'` `echo \\`echo hi\\``")
+    keys = "test" + EX
+    wanted = "/ 0 hi"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsShellWorker = 1")
+
+
+class TabStop_Shell_OutputTruncated(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "`seq 1 100000`")
+    keys = "test" + EX
+    wanted = "1\n2\n[output truncated to 4 bytes]"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsShellMaxOutput = 4")
+
+
+class TabStop_Shell_Timeout(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "`echo hi; sleep 60`")
+    keys = "test" + EX
+    wanted = "hi\n[stopped after 1 seconds]"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsShellTimeout = 1")
+
+
+class TabStop_Shell_FindTmpAtStartup(_VimTest):
+    skip_if = lambda self: running_on_windows()
+    snippets = ("test", "hi `echo hallo`")
+    keys = "test" + EX
+    wanted = "hi hallo"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsShellFindTmpAtStartup = 1")
+
+
 class TabStop_Shell_InDefValue_Leave(_VimTest):
     skip_if = lambda self: running_on_windows()
     snippets = ("test", "Hallo ${1:now `echo fromecho`} end")
@@ -74,6 +148,26 @@ class TabStop_VimScriptInterpolation_SimpleExample(_VimTest):
     wanted = "    hi 4 End"
 
 
+class TabStop_VimScriptInterpolation_Several(_VimTest):
+    snippets = ("test", """`!v indent(".")` `!v 1 + 1`\n`!v toupper('x')`""")
+    keys = "    test" + EX
+    wanted = "    4 2\n    X"
+
+
+class TabStop_VimScriptInterpolation_AfterPythonCode(_VimTest):
+    snippets = (
+        "test",
+        """`!p snip.volatile = True
+vim.command("let g:ultisnips_test = 'new'")``!v g:ultisnips_test` `!v g:ultisnips_test``!p snip.volatile = True
+vim.command("let g:ultisnips_test = 'old'")`""",
+    )
+    keys = "test" + EX
+    wanted = "new new"
+
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:ultisnips_test = 'old'")
+
+
 class PythonCodeOld_SimpleExample(_VimTest):
     snippets = ("test", """hi `!p res = "Hallo"` End""")
     keys = "test" + EX
@@ -150,6 +244,56 @@ class PythonCode_ReferencePlaceholderBefore(_VimTest):
     wanted = "##########\nHallo Welt"
 
 
+class PythonCode_ReferencePlaceholderBeforeContainingMirror(_VimTest):
+    snippets = ("test", """`!p snip.rv = t[1]` ${1:$2} ${2:x}""")
+    keys = "test" + EX + JF + "abc"
+    wanted = "abc abc abc"
+
+
+class PythonCode_RerunWhenLocalsChange(_VimTest):
+    snippets = ("test", """${1:a} `!p x = t[1].upper()`${2:b} `!p snip.rv = x`""")
+    keys = "test" + EX + "hi" + JF + "ho"
+    wanted = "hi ho HI"
+
+
+class PythonCode_RunInBackground(_VimTest):
+    snippets = (
+        "test",
+        """${1:a} `!p snip.background = True
+snip.rv = t[1].upper()`""",
+    )
+    keys = "test" + EX + "hi"
+    wanted = "hi HI"
+
+
+class PythonCode_RunInForegroundIfVimIsUsed(_VimTest):
+    snippets = (
+        "test",
+        """${1:a} `!p snip.background = True
+snip.rv = t[1] + str(len(vim.current.window.cursor))`""",
+    )
+    keys = "test" + EX + "hi"
+    wanted = "hi hi2"
+
+
+class PythonCode_RunInForegroundIfGlobalFunctionIsCalled(_VimTest):
+    files = {
+        "us/all.snippets": r"""
+        global !p
+        def first():
+            return t[1].upper()
+        endglobal
+
+        snippet test
+        ${1:a} `!p snip.background = True
+        snip.rv = first()`
+        endsnippet
+        """
+    }
+    keys = "test" + EX + "hi"
+    wanted = "hi HI"
+
+
 class PythonCode_TransformedBeforeMultiLine(_VimTest):
     snippets = (
         "test",
@@ -501,6 +645,20 @@ class PythonCode_CanOverwriteTabstop(_VimTest):
     wanted = "bl-\n\tah, bah"
 
 
+class PythonCode_WritesToBufferInVim(_VimTest):
+    snippets = (
+        "test",
+        """$1
+line `!p if t[1] == "ab" and snip.c != "(ab)":
+    for idx, line in enumerate(vim.current.buffer):
+        if line.startswith("line"):
+            vim.current.buffer[idx] = "LINE" + line[4:]
+snip.rv = "(" + t[1] + ")"`""",
+    )
+    keys = "test" + EX + "abc"
+    wanted = "abc\nLINE (abc)"
+
+
 class PythonVisual_NoVisualSelection_Ignore(_VimTest):
     snippets = ("test", "h`!p snip.rv = snip.v.mode + snip.v.text`b")
     keys = "test" + EX + "abc"
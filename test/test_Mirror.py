@@ -288,3 +288,21 @@ class Mirror_TestKillTabstop_Kill(_VimTest):
     snippets = "test", "welt${1:welt${2:welt}welt} $2"
     keys = "hallo test" + EX + "elt"
     wanted = "hallo weltelt "
+
+
+class Mirror_AdjacentEmptyTabstopsAndMirrors(_VimTest):
+    snippets = ("test", "$1$2$1$2$3")
+    keys = "test" + EX + "a" + JF + "bc" + JF + "d"
+    wanted = "abcabcd"
+
+
+class Mirror_AdjacentEmptyTabstopsAndMirrors_Delete(_VimTest):
+    snippets = ("test", "$1$2$1$2$3")
+    keys = "test" + EX + "ab" + BS + JF + "cd" + BS + JF + "e"
+    wanted = "acace"
+
+
+class Mirror_AdjacentEmptyTabstopsAndMirrorsOnLines(_VimTest):
+    snippets = ("test", "$1$2\n$2$1$3")
+    keys = "test" + EX + "a" + JF + "b" + JF + "c"
+    wanted = "ab\nbac"
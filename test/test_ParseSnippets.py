@@ -275,6 +275,54 @@ endsnippet
     wanted = "x first a bob b y"
 
 
+class ParseSnippets_Global_RunsOnce(_VimTest):
+    files = {
+        "us/all.snippets": r"""
+global !p
+token = random.random()
+endglobal
+
+snippet ab
+x `!p first = token` `!p snip.rv = first == token` y
+endsnippet
+        """
+    }
+    keys = "ab" + EX
+    wanted = "x  True y"
+
+
+class ParseSnippets_Global_ClassUsesRunNames(_VimTest):
+    files = {
+        "us/all.snippets": r"""
+global !p
+import functools
+
+class Writer:
+    def write(self, text):
+        snip.rv = text + t[1]
+
+def twice(function):
+    @functools.wraps(function)
+    def wrapper():
+        return function() * 2
+    return wrapper
+
+@twice
+def tabstop():
+    return t[1]
+
+helpers = {"upper": lambda: t[1].upper()}
+endglobal
+
+snippet ab
+$1 `!p Writer().write("w:")` `!p snip.rv = tabstop()` `!p snip.rv = helpers["upper"]()`
+endsnippet
+        """
+    }
+    keys = "ab" + EX + "hi"
+    wanted = "hi w:hi hihi HI"
+
+
 class ParseSnippets_PrintPythonStacktrace(_VimTest):
     files = {
         "us/all.snippets": r"""
@@ -484,3 +484,26 @@ class TabStop_KeepCorrectJumpListOnOverwriteOfPartOfSnippetRE(_VimTest):
     }
     keys = "i" + EX + EX + "1" + JF + "2" + JF + " after" + JF + "3"
     wanted = "ia(1, 2) after: 3"
+
+
+class _TrackPositionsWithMarks(_VimTest):
+    def _extra_vim_config(self, vim_config):
+        vim_config.append("let g:UltiSnipsTrackPositionsWithMarks = 1")
+
+
+class TabStop_TrackWithMarks_TypeInTabstop(_TrackPositionsWithMarks):
+    snippets = ("test", "hi ${1:default} there ${2:two} end")
+    keys = "test" + EX + "abc" + BS + "d" + JF + "xyz" + JF + "!"
+    wanted = "hi abd there xyz end!"
+
+
+class TabStop_TrackWithMarks_ReplayWithMirror(_TrackPositionsWithMarks):
+    snippets = ("test", "${1:a} $1\n${2:b}")
+    keys = "test" + EX + "one\ntwoo" + BS + JF + "x"
+    wanted = "one\ntwo one\ntwo\nx"
+
+
+class TabStop_TrackWithMarks_TypeInNestedTabstop(_TrackPositionsWithMarks):
+    snippets = ("test", "(${1:x ${2:y}}) ${3:z}")
+    keys = "test" + EX + JF + "abc" + BS + JF + "end"
+    wanted = "(x ab) end"
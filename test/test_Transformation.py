@@ -266,6 +266,12 @@ class Transformation_ConditionalWithEscapedDelimiter(_VimTest):
     wanted = "aa yes:no)"
 
 
+class Transformation_ConditionalWithParenthesesInGroup(_VimTest):
+    snippets = "test", r"$1 ${1/(\w+)(\(\w*\))?/(?2:\u$1$2:$1)/g}"
+    keys = "test" + EX + "f(x) g"
+    wanted = "f(x) g F(x) g"
+
+
 class Transformation_ConditionalWithBackslashBeforeDelimiter(_VimTest):
     snippets = "test", r"$1 ${1/(aa)|.*/(?1:yes\\:no)/}"
     keys = "test" + EX + "aa"
@@ -276,3 +282,51 @@ class Transformation_ConditionalWithBackslashBeforeDelimiter1(_VimTest):
     snippets = "test", r"$1 ${1/(aa)|.*/(?1:yes:no\\)/}"
     keys = "test" + EX + "ab"
     wanted = "ab no\\"
+
+
+class Transformation_CaseSwitchesAndFolds(_VimTest):
+    snippets = "test", r"$1 ${1/(\w+)_(\w+)/\u$1\U$2\E$1/}"
+    keys = "test" + EX + "foo_bar"
+    wanted = "foo_bar FooBARfoo"
+
+
+class Transformation_CaseSwitchesAndFoldsGlobal(_VimTest):
+    snippets = "test", r"$1 ${1/(\w)(\w*)/\l$1\L$2\E-\U$1$2\E/g}"
+    keys = "test" + EX + "HeLLo WoRLD"
+    wanted = "HeLLo WoRLD hello-HELLO world-WORLD"
+
+
+class Transformation_CaseSwitchBeforeFold(_VimTest):
+    snippets = "test", r"$1 ${1/(\w+)/\u\L$1\E!/}"
+    keys = "test" + EX + "WORD"
+    wanted = "WORD word!"
+
+
+class Transformation_CaseSwitchAtEnd(_VimTest):
+    snippets = "test", r"$1 ${1/(x)?(.*)/\u$1$2\u/}"
+    keys = "test" + EX + "rest"
+    wanted = "rest Restu"
+
+
+class Transformation_ConditionalsWithEscapes(_VimTest):
+    snippets = "test", r"$1 ${1/(a)?(b)?/(?1:A\:\(1\):-)(?2:B:\))/}"
+    keys = "test" + EX + "b"
+    wanted = "b -B"
+
+
+class Transformation_ConditionalWithFoldGlobal(_VimTest):
+    snippets = "test", r"$1 ${1/(\w+)(\s*)/(?2:\u$1 :\U$1\E)/g}"
+    keys = "test" + EX + "ab cd"
+    wanted = "ab cd Ab CD"
+
+
+class Transformation_ConditionalWithParenthesesInBranch(_VimTest):
+    snippets = "test", r"$1 ${1/(x)?(.*)/(?1:yes(no):$2\l)/}"
+    keys = "test" + EX + "Rest"
+    wanted = "Rest Rest"
+
+
+class Transformation_EscapesInReplacement(_VimTest):
+    snippets = "test", r"$1 ${1/(.*)/\t$1|\\|\$1/}"
+    keys = "test" + EX + "x"
+    wanted = "x \tx|\\|x"